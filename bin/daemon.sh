@@ -0,0 +1,71 @@
+#!/bin/bash
+#
+# Copyright 2018 Alexandru Catrina
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+source libs/common.sh
+
+# define constants
+export HAP_DAEMON=hap-manager
+export SYSTEMD_UNIT_FILE_PATH=/lib/systemd/system
+
+# annouce user about next steps
+console "Installing the manager daemon requires root privileges. Make sure you"
+console "have previously installed hap utils as the user running the jobs."
+
+# ask for path to manager script
+console "Please type the absolute path to your installed manager below."
+read -p "Path: " manager
+if [ -z "$manager" ]; then
+    console err "Error: path is empty!"
+    close $FAILURE
+elif [ ! -x "$manager" ]; then
+    console err "Error: path to manager is invalid!"
+    close $FAILURE
+fi
+
+# copy manager systemd unit file
+cat > $SYSTEMD_UNIT_FILE_PATH/${HAP_DAEMON}.service <<EOL
+[Unit]
+Description=Hap! Manager ($(uname -n))
+After=network.target
+
+[Service]
+User=${SUDO_USER:-$(whoami)}
+ExecStart=$manager --daemon
+Restart=always
+RestartSec=10
+StandardOutput=syslog
+StandardError=syslog
+WorkingDirectory=$(dirname "$manager")
+SyslogIdentifier=$HAP_DAEMON
+
+[Install]
+WantedBy=multi-user.target
+Alias=${HAP_DAEMON}.service
+EOL
+
+# train user
+console "Manager daemon installed on local machine."
+console "You can now enable your service and control it through systemd:"
+console "  service ${HAP_DAEMON} {start|restart|stop|status}"
+console "Remove the manager entry from your crontab once the service is started:"
+console "  crontab -e"
+console "Keep in mind that any changes require a restart"
@@ -35,7 +35,7 @@ export HAP_GENERATOR=hap-generator
 export HAP_VALIDATOR=hap-validator
 export HAP_VIEWER=hap-viewer
 export HAP_MANAGER=hap-manager
-export HAP_OPTIONS="register unregister dataplans check join jobs pause purge resume logs dump upgrade fix"
+export HAP_OPTIONS="register unregister dataplans check join jobs pause purge resume configure logs dump migrate rebase compact stats upgrade fix"
 export HAP_HOME=$HOME/bin
 
 # validations here
@@ -164,16 +164,22 @@ if [ \$# -eq 0 ] || [ "x\$1" = "xhelp" ]; then
     echo ""
     echo "Options:"
     echo "  input [flags]               - File with JSON formated dataplan"
-    echo "  dataplans                   - List all master dataplans available"
+    echo "  dataplans [--json]          - List all master dataplans available"
     echo "  register [DATAPLAN | name]  - Register new dataplan or create it"
     echo "  unregister DATAPLAN         - Unregister existing dataplan"
     echo "  check DATAPLAN LINK         - Run once a dataplan with a link and test its output"
     echo "  jobs                        - List all background jobs"
-    echo "  join DATAPLAN LINK          - Add background job with a dataplan and a link"
+    echo "  join DATAPLAN LINK [HOURS]  - Add background job with a dataplan and a link"
+    echo "  join DATAPLAN --from FILE   - Add background jobs for every link of a file (or - for stdin)"
     echo "  purge LINK                  - Permanently remove a background job"
     echo "  pause LINK                  - Temporary pause a background job"
-    echo "  resume LINK                 - Resume a paused a background job"
-    echo "  dump LINK                   - Export job's stored records as tsv"
+    echo "  resume LINK                 - Resume a paused or dead background job"
+    echo "  configure LINK KEY VALUE    - Change a setting of a background job"
+    echo "  dump LINK [flags]           - Export job's stored records as tsv"
+    echo "  migrate                     - Upgrade records and dataplans of jobs created by older versions"
+    echo "  rebase DATAPLAN             - Move all jobs of a dataplan to its current version"
+    echo "  compact [LINK] [flags]      - Archive old records of a job or of all jobs"
+    echo "  stats [DATAPLAN] [flags]    - Show timings and outcomes of recent job runs"
     echo "  logs                        - View recent log activity"
     echo "  upgrade                     - Upgrade Hap! to the latest version"
     echo ""
@@ -185,6 +191,23 @@ if [ \$# -eq 0 ] || [ "x\$1" = "xhelp" ]; then
     echo "  --refresh                   - Reset stored records before save"
     echo "  --silent                    - Suppress any output"
     echo ""
+    echo "Dump flags:"
+    echo "  --since DATE                - Export records collected since date (YYYY-MM-DD [HH:MM:SS])"
+    echo "  --until DATE                - Export records collected until date (YYYY-MM-DD [HH:MM:SS])"
+    echo "  --format FORMAT             - Export as tsv (default), csv or columnar"
+    echo "  --output PATH               - Export to file path or to stdout with -"
+    echo "  --expand                    - Repeat unchanged records for every run"
+    echo ""
+    echo "Compact flags:"
+    echo "  --keep N                    - Keep the last N records of each job"
+    echo "  --days N                    - Keep the records collected in the last N days"
+    echo "  --downsample PERIOD         - Keep one of the older records per day or week"
+    echo ""
+    echo "Stats flags:"
+    echo "  --hours N                   - Show runs of the last N hours (default 24)"
+    echo "  --slowest N                 - Show the N slowest links (default 10)"
+    echo "  --prometheus PATH           - Export statistics as a Prometheus text file"
+    echo ""
     exit 0
 fi
 
@@ -26,11 +26,36 @@ from __future__ import print_function
 import io
 import os
 import sys
+import copy
 import json
 import time
+import math
+import calendar
+import array
+import struct
+import getopt
+import datetime
+import fcntl
+import threading
 import subprocess
+import multiprocessing
+import Queue
+import heapq
+import collections
 import xmlrpclib
 import socket
+import urllib
+import urllib2
+import hashlib
+import gzip
+import shutil
+import errno
+import tempfile
+import httplib
+import signal
+import resource
+
+from urlparse import urlparse
 
 try:
     import sqlite3
@@ -62,11 +87,101 @@ JOBS_DIRECTORY = os.environ.get("HAP_JOBS_DIR")
 if not JOBS_DIRECTORY or len(JOBS_DIRECTORY.strip()) == 0:
     raise SystemExit("Missing HAP_JOBS_DIR environment parameter")
 
+# define directory of master dataplan snapshots referenced by jobs
+MASTERS_DIRECTORY = os.path.join(JOBS_DIRECTORY, ".masters")
+
 # define dataplans dir
 DATAPLANS_DIR = os.environ.get("HAP_DIR")
 if not DATAPLANS_DIR or len(DATAPLANS_DIR.strip()) == 0:
     raise SystemExit("Missing HAP_DIR environment parameter")
 
+# read a numeric parameter from environment
+def env_number(name, default, minimum=1):
+    try:
+        value = int(os.environ.get(name, default))
+    except ValueError:
+        raise SystemExit("Invalid {} environment parameter".format(name))
+    if value < minimum:
+        raise SystemExit("Parameter {} must be at least {}".format(name, minimum))
+    return value
+
+# define worker pool size
+WORKERS = env_number("HAP_WORKERS", 4)
+
+# define max concurrent jobs per host
+WORKERS_PER_HOST = env_number("HAP_WORKERS_PER_HOST", 1)
+
+# define max jobs started per minute on the same host (0 means unlimited)
+HOST_RATE = env_number("HAP_HOST_RATE", 0, minimum=0)
+
+# define max jobs started at once on the same host when rate is limited
+HOST_BURST = env_number("HAP_HOST_BURST", 1)
+
+# define seconds before retrying a failed job for the first time (doubled on each failure)
+RETRY_DELAY = env_number("HAP_RETRY_DELAY", 300)
+
+# define consecutive failures after which a job is no longer performed
+MAX_FAILURES = env_number("HAP_MAX_FAILURES", 5)
+
+# define max seconds a job may run before it is killed (0 means unlimited)
+JOB_TIMEOUT = env_number("HAP_JOB_TIMEOUT", 300, minimum=0)
+
+# define max megabytes of memory for the process performing a job (0 means unlimited)
+JOB_MEMORY = env_number("HAP_JOB_MEMORY", 0, minimum=0)
+
+# define max seconds of cpu time a job may use (0 means unlimited)
+JOB_CPU = env_number("HAP_JOB_CPU", 0, minimum=0)
+
+# define days of per-run statistics kept in the jobs database
+STATS_DAYS = env_number("HAP_STATS_DAYS", 7)
+
+# define path of the prometheus text file written after every run (empty disables)
+STATS_TEXTFILE = os.environ.get("HAP_STATS_TEXTFILE", "")
+
+# define stages of a job run measured in statistics
+STATS_STAGES = ("wait", "spawn", "fetch", "extract", "save", "total", "callback")
+
+# define jobs database schema version
+SCHEMA_VERSION = 11
+
+# define seconds a job is leased to a manager process
+LEASE_TIME = env_number("HAP_LEASE_TIME", 3600)
+
+# define max jobs claimed by a manager process (0 means unlimited)
+BATCH_SIZE = env_number("HAP_BATCH_SIZE", 0, minimum=0)
+
+# define seconds to wait for the RPC server on callbacks
+CALLBACK_TIMEOUT = env_number("HAP_CALLBACK_TIMEOUT", 10)
+
+# define max callbacks delivered in one RPC call
+CALLBACK_BATCH = env_number("HAP_CALLBACK_BATCH", 100)
+
+# define max delivery attempts of a callback before dropping it
+CALLBACK_RETRIES = env_number("HAP_CALLBACK_RETRIES", 8)
+
+# define fault code of RPC servers asking to deliver callbacks later
+CALLBACK_BUSY = 429
+
+# define how jobs are performed (worker or subprocess)
+HAP_ENGINE = os.environ.get("HAP_ENGINE", "worker")
+if HAP_ENGINE not in ("worker", "subprocess"):
+    raise SystemExit("Unsupported HAP_ENGINE environment parameter")
+
+# define max seconds the daemon sleeps between checks for changed jobs
+DAEMON_POLL = env_number("HAP_DAEMON_POLL", 5)
+
+# define max upcoming runs kept in the daemon timer heap
+DAEMON_TIMERS = 1 << 10
+
+# define size in bytes after which records are sealed into a compressed segment (0 disables)
+SEGMENT_SIZE = env_number("HAP_SEGMENT_SIZE", 0, minimum=0)
+
+# define export buffer size
+EXPORT_BUFFER = 1 << 16
+
+# define max rows per columnar export chunk
+EXPORT_CHUNK = 1 << 16
+
 # fetch all registered dataplans
 def dataplans():
     for dataplan in os.listdir(DATAPLANS_DIR):
@@ -75,31 +190,227 @@ def dataplans():
             continue
         yield dataplan
 
+# parse date as YYYY-MM-DD with optional time HH:MM:SS[.ffffff]
+def parse_datetime(value):
+    for fmt in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            moment = datetime.datetime.strptime(value.strip(), fmt)
+        except ValueError:
+            continue
+        return time.mktime(moment.timetuple()) + moment.microsecond / 1e6
+    return None
+
+# get record datetime as timestamp (older hap saved it as text)
+def record_time(record):
+    value = record.get("_datetime")
+    if isinstance(value, (int, long, float)):
+        return float(value)
+    if isinstance(value, basestring):
+        return parse_datetime(value)
+    return None
+
+# hash declared fields of a record regardless of when it was collected
+def record_digest(record):
+    fields = dict([(k, v) for k, v in record.iteritems() if k != "_datetime"])
+    return hashlib.sha1(json.dumps(fields, sort_keys=True)).hexdigest()
+
+# check if record only marks a run with the same fields as the previous record
+def is_heartbeat(record):
+    return record.get("_unchanged") is True
+
+# format record datetime as text
+def format_datetime(value):
+    if isinstance(value, (int, long, float)):
+        moment = datetime.datetime.fromtimestamp(value)
+        return unicode(moment.strftime("%Y-%m-%d %H:%M:%S.%f"))
+    return unicode(value if value is not None else "n/a")
+
+# quote csv cell if needed
+def quote_csv(cell):
+    if any(c in cell for c in (u",", u"\"", u"\n", u"\r")):
+        return u'"{}"'.format(cell.replace(u'"', u'""'))
+    return cell
+
+# path to the append-only records file of a job
+def records_file(job_file):
+    return os.path.splitext(job_file)[0] + ".jsonl"
+
+# master dataplan snapshots already read by this process, by content hash
+MASTERS = {}
+
+# save a master dataplan snapshot named after the hash of its content
+def save_master(data):
+    data = dict([(k, v) for k, v in data.items() if k not in ("link", "records")])
+    content = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    digest = hashlib.sha1(content).hexdigest()
+    filepath = os.path.join(MASTERS_DIRECTORY, digest + ".json")
+    if not os.path.exists(filepath):
+        try:
+            os.makedirs(MASTERS_DIRECTORY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        handle, tmp_file = tempfile.mkstemp(suffix=".tmp", dir=MASTERS_DIRECTORY)
+        try:
+            with os.fdopen(handle, "w") as fd:
+                fd.write(content)
+            os.chmod(tmp_file, 0o644)
+            os.rename(tmp_file, filepath)  # same content, so the last writer can win
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+    return digest
+
+# read a master dataplan snapshot once per process
+def load_master(digest):
+    if digest not in MASTERS:
+        with open(os.path.join(MASTERS_DIRECTORY, digest + ".json")) as fd:
+            MASTERS[digest] = json.load(fd)
+    return MASTERS[digest]
+
+# merge overrides of a job into a copy of its master dataplan
+def merge_plan(master, overrides):
+    plan = copy.deepcopy(master)
+    for k, v in overrides.items():
+        if isinstance(v, dict) and isinstance(plan.get(k), dict):
+            plan[k] = merge_plan(plan[k], v)
+        else:
+            plan[k] = v
+    return plan
+
+# read the dataplan of a job, built from the master snapshot it references if any
+def load_plan(job_file):
+    with open(job_file) as fd:
+        job = json.load(fd)
+    master = job.pop("master", None)
+    return job if master is None else merge_plan(load_master(master), job)
+
+# write a job file referencing a master dataplan snapshot
+def write_reference(job_file, master, overrides):
+    overrides = dict(overrides, master=master)
+    with open(job_file + ".tmp", "w") as fd:
+        json.dump(overrides, fd, separators=(",", ":"))
+    os.rename(job_file + ".tmp", job_file)
+
+# next run of a job in a slot of its interval given by the hash of its link,
+# so jobs of the same host added at once are spread across the interval
+def next_slot(link, interval, now=None):
+    period = max(int(float(interval) * 3600), 1)
+    phase = int(hashlib.md5(link.encode("utf-8")).hexdigest()[:8], 16) % period
+    earliest = (now or time.time()) + period / 2.0
+    return earliest + (phase - earliest) % period
+
 # parse job fields
 def parse_job(job, retval):
-    link, fname, fpath, freq, cb, com, s_date, p_date, last_run, status = job
-    if retval == "link":
-        return link
-    elif retval == "dataplan":
-        return fname
-    elif retval == "job_file":
-        return fpath
-    elif retval == "interval":
-        return freq
-    elif retval == "callback":
-        return cb
-    elif retval == "comment":
-        return com
-    elif retval == "start_date":
-        return s_date
-    elif retval == "pause_date":
-        return p_date
-    elif retval == "last_run":
-        return last_run
-    elif retval == "status":
-        return status
+    for index, (field, _) in enumerate(Jobs.fields):
+        if field == retval:
+            return job[index]
     raise SystemExit("Undefined return value after parsing job")
 
+# find seconds a job may run from its settings, its dataplan meta or the default
+def job_timeout(job):
+    timeout = parse_job(job, "timeout")
+    if timeout is None:
+        try:
+            timeout = load_plan(parse_job(job, "job_file")).get("meta", {}).get("timeout")
+        except (IOError, ValueError, AttributeError):
+            pass
+    try:
+        return max(float(timeout), 0)
+    except (TypeError, ValueError):
+        return JOB_TIMEOUT
+
+# measure the address space of the current process in bytes (0 if unknown)
+def address_space():
+    try:
+        with open("/proc/self/statm") as fd:
+            return int(fd.read().split()[0]) * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        return 0
+
+# cap memory and cpu time of the current process to what the next job may use on top of it
+def limit_resources():
+    if JOB_MEMORY > 0:
+        limit = address_space() + JOB_MEMORY * 1024 * 1024
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    if JOB_CPU > 0:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        resource.setrlimit(resource.RLIMIT_CPU, (int(usage.ru_utime + usage.ru_stime) + JOB_CPU, hard))
+
+# start hap in its own process group, so that it can be killed with its children, and with
+# the resource limits of a job; a separate program applies them since the threaded manager
+# cannot safely run python code between fork and exec
+SESSION_WRAPPER = r"""
+import os, sys, resource
+os.setsid()
+memory, cpu = int(sys.argv[1]), int(sys.argv[2])
+if memory > 0:
+    resource.setrlimit(resource.RLIMIT_AS, (memory * 1024 * 1024, memory * 1024 * 1024))
+if cpu > 0:
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+os.execvp(sys.argv[3], sys.argv[3:])
+"""
+
+def session_command(cmd):
+    return [sys.executable, "-c", SESSION_WRAPPER, str(JOB_MEMORY), str(JOB_CPU)] + cmd
+
+# kill a process group unless it already exited
+def kill_group(pgid, killed):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        try:
+            os.kill(pgid, signal.SIGKILL)  # not in its own group yet
+        except OSError:
+            return
+    killed.set()
+
+# describe how a process performing a job exited
+def exit_error(code, timeout=None):
+    if timeout is not None:
+        return "Timed out after {:g} seconds".format(timeout)
+    if code == -signal.SIGXCPU:
+        return "Exceeded cpu time limit of {} seconds".format(JOB_CPU)
+    if code < 0:
+        return "hap was killed by signal {}".format(-code)
+    return "hap exited with code {}".format(code)
+
+
+class ProcessLock(object):
+
+    def __init__(self, filepath=None):
+        self.filepath = filepath or JOBS_DATABASE + ".lock"
+
+    def __enter__(self):
+        self.fd = open(self.filepath, "a")
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.fd.close()
+
+
+class Database(object):
+
+    connection, lock = None, threading.RLock()
+    max_variables = 500
+
+    @classmethod
+    def connect(cls):
+        with cls.lock:
+            if cls.connection is None:
+                db = sqlite3.connect(JOBS_DATABASE, timeout=30,
+                                     check_same_thread=False, cached_statements=256)
+                db.execute(r"PRAGMA journal_mode=WAL")
+                db.execute(r"PRAGMA synchronous=NORMAL")
+                cls.connection = db
+        return cls.connection
+
 
 class Jobs(object):
 
@@ -113,76 +424,729 @@ class Jobs(object):
         ("start_date", "text"),
         ("pause_date", "text"),
         ("last_run",   "text"),
-        ("status",     "text"),
+        ("status",     "text"),  # retry or dead after failures
+        ("next_run_at", "text"),
+        ("lease_owner", "text"),
+        ("lease_expires", "text"),
+        ("etag",          "text"),
+        ("last_modified", "text"),
+        ("content_hash",  "text"),
+        ("store",         "text"),  # all or changes
+        ("record_hash",   "text"),
+        ("exit_code",     "integer"),
+        ("failures",      "integer default 0"),
+        ("last_error",    "text"),
+        ("timeout",       "integer"),
+    )
+
+    summary_fields = (
+        ("job_file",    "text primary key"),
+        ("name",        "text"),
+        ("fields",      "text"),
+        ("records",     "integer"),
+        ("last_record", "real"),
+        ("file_size",   "integer"),
+        ("file_mtime",  "real"),
+    )
+
+    outbox_fields = (
+        ("id",              "integer primary key"),
+        ("callback",        "text"),
+        ("job_file",        "text"),
+        ("record_offset",   "integer"),
+        ("records",         "text"),
+        ("attempts",        "integer default 0"),
+        ("next_attempt_at", "text default current_timestamp"),
+        ("run_id",          "integer"),
+    )
+
+    stats_fields = (
+        ("id",          "integer primary key"),
+        ("link",        "text"),
+        ("dataplan",    "text"),
+        ("finished_at", "real"),
+        ("outcome",     "text"),  # stored, unchanged, not_modified or failed
+        ("records",     "integer"),
+    ) + tuple([(stage, "real") for stage in STATS_STAGES])
+
+    counters_fields = (
+        ("name",  "text primary key"),
+        ("value", "integer default 0"),
+    )
+
+    hosts_fields = (
+        ("host",    "text primary key"),
+        ("tokens",  "real"),
+        ("updated", "real"),
     )
 
     def __init__(self, name="jobs"):
         self.dbname = name
-        self.db = sqlite3.connect(JOBS_DATABASE)
+        self.columns = ",".join([k for k, _ in self.fields])
+        self.db = Database.connect()
 
     def initialize(self):
+        self.cursor.execute(r"PRAGMA user_version")
+        if self.cursor.fetchone()[0] >= SCHEMA_VERSION:
+            return
         fields = ",".join(["{} {}".format(k, v.upper()) for k, v in self.fields])
         self.cursor.execute(r"CREATE TABLE IF NOT EXISTS {} ({})".format(
             self.dbname, fields))
+        self.migrate()
+        self.cursor.execute(r"CREATE INDEX IF NOT EXISTS {0}_due ON {0} (pause_date, next_run_at)".format(
+            self.dbname))
+        self.cursor.execute(r"CREATE INDEX IF NOT EXISTS {0}_lease ON {0} (lease_owner)".format(
+            self.dbname))
+        fields = ",".join(["{} {}".format(k, v.upper()) for k, v in self.summary_fields])
+        self.cursor.execute(r"CREATE TABLE IF NOT EXISTS {}_summary ({})".format(
+            self.dbname, fields))
+        fields = ",".join(["{} {}".format(k, v.upper()) for k, v in self.outbox_fields])
+        self.cursor.execute(r"CREATE TABLE IF NOT EXISTS {}_outbox ({})".format(
+            self.dbname, fields))
+        self.add_columns("{}_outbox".format(self.dbname), self.outbox_fields)
+        self.cursor.execute(r"CREATE INDEX IF NOT EXISTS {0}_outbox_due ON {0}_outbox (next_attempt_at)".format(
+            self.dbname))
+        fields = ",".join(["{} {}".format(k, v.upper()) for k, v in self.stats_fields])
+        self.cursor.execute(r"CREATE TABLE IF NOT EXISTS {}_stats ({})".format(
+            self.dbname, fields))
+        self.cursor.execute(r"CREATE INDEX IF NOT EXISTS {0}_stats_finished ON {0}_stats (finished_at)".format(
+            self.dbname))
+        fields = ",".join(["{} {}".format(k, v.upper()) for k, v in self.counters_fields])
+        self.cursor.execute(r"CREATE TABLE IF NOT EXISTS {}_counters ({})".format(
+            self.dbname, fields))
+        fields = ",".join(["{} {}".format(k, v.upper()) for k, v in self.hosts_fields])
+        self.cursor.execute(r"CREATE TABLE IF NOT EXISTS {}_hosts ({})".format(
+            self.dbname, fields))
+        self.cursor.execute(r"PRAGMA user_version={}".format(SCHEMA_VERSION))
         self.db.commit()
 
-    def insert(self, dataplan, job_file, link):
+    def add_columns(self, table, fields):
+        self.cursor.execute(r"PRAGMA table_info({})".format(table))
+        existing = [row[1] for row in self.cursor.fetchall()]
+        added = [(k, v) for k, v in fields if k not in existing]
+        for k, v in added:
+            self.cursor.execute(r"ALTER TABLE {} ADD COLUMN {} {}".format(table, k, v.upper()))
+        return [k for k, _ in added]
+
+    def migrate(self):
+        for k in self.add_columns(self.dbname, self.fields):
+            if k == "next_run_at":
+                self.cursor.execute(
+                    r"UPDATE {} SET next_run_at=COALESCE("
+                    r"DATETIME(last_run, '+' || interval || ' hours'), CURRENT_TIMESTAMP)".format(self.dbname))
+
+    def insert(self, dataplan, job_file, link, interval=24):
+        self.insert_many([(dataplan, job_file, link, interval)])
+
+    def insert_many(self, rows):
         fields = "dataplan, job_file, link, interval"
-        values = [dataplan, job_file, link, 24]
-        self.cursor.execute(r"INSERT INTO {} ({}, start_date) VALUES ({},CURRENT_TIMESTAMP)".format(
-            self.dbname, fields, ",".join(["?" for _ in values])), values)
-        self.db.commit()
+        self.cursor.executemany(r"INSERT INTO {} ({}, start_date, next_run_at) VALUES ({},CURRENT_TIMESTAMP,CURRENT_TIMESTAMP)".format(
+            self.dbname, fields, ",".join(["?" for _ in fields.split(",")])), rows)
+
+    def links(self):
+        self.cursor.execute(r"SELECT link FROM {}".format(self.dbname))
+        return set([row[0] for row in self.cursor.fetchall()])
 
     def delete(self, link):
         self.cursor.execute(r"DELETE FROM {} WHERE link=?".format(
             self.dbname), [link])
-        self.db.commit()
 
-    def ping(self, link):
-        self.cursor.execute(r"UPDATE {} SET last_run=CURRENT_TIMESTAMP WHERE link=?".format(
-            self.dbname), [link])
-        self.db.commit()
+    def finish(self, link, owner, next_run_at, exit_code=0):
+        self.cursor.execute(
+            r"UPDATE {} SET last_run=CURRENT_TIMESTAMP, next_run_at=DATETIME(?, 'unixepoch'), "
+            r"status=NULL, exit_code=?, failures=0, last_error=NULL, "
+            r"lease_owner=NULL, lease_expires=NULL WHERE link=? AND lease_owner=?".format(
+                self.dbname), [int(next_run_at), exit_code, link, owner])
+
+    def fail(self, link, owner, exit_code, error):
+        failures = r"COALESCE(failures, 0) + 1"
+        self.cursor.execute(
+            r"UPDATE {0} SET last_run=CURRENT_TIMESTAMP, exit_code=?, last_error=?, failures={1}, "
+            r"status=CASE WHEN {1} >= ? THEN 'dead' ELSE 'retry' END, "
+            r"next_run_at=CASE WHEN {1} >= ? THEN NULL ELSE DATETIME('now', '+' || "
+            r"MIN(? * (1 << COALESCE(failures, 0)), interval * 3600) || ' seconds') END, "
+            r"lease_owner=NULL, lease_expires=NULL WHERE link=? AND lease_owner=?".format(
+                self.dbname, failures), [exit_code, error, MAX_FAILURES, MAX_FAILURES, RETRY_DELAY, link, owner])
+
+    def revive(self, link):
+        self.cursor.execute(
+            r"UPDATE {} SET status=NULL, failures=0, next_run_at=CURRENT_TIMESTAMP "
+            r"WHERE link=? AND status='dead'".format(self.dbname), [link])
+
+    def clear_validators(self, dataplan):
+        self.cursor.execute(
+            r"UPDATE {} SET etag=NULL, last_modified=NULL, content_hash=NULL WHERE dataplan=?".format(
+                self.dbname), [dataplan])
+
+    def save_validators(self, link, etag, last_modified, content_hash):
+        self.cursor.execute(
+            r"UPDATE {} SET etag=?, last_modified=?, content_hash=? WHERE link=?".format(
+                self.dbname), [etag, last_modified, content_hash, link])
+
+    def lease(self, link, owner, lease):
+        self.cursor.execute(
+            r"UPDATE {} SET lease_owner=?, lease_expires=DATETIME('now', '+' || ? || ' seconds') "
+            r"WHERE link=? AND (lease_expires IS NULL OR lease_expires <= CURRENT_TIMESTAMP)".format(
+                self.dbname), [owner, lease, link])
+        return self.cursor.rowcount > 0
+
+    def renew(self, link, owner, lease):
+        self.cursor.execute(
+            r"UPDATE {} SET lease_expires=DATETIME('now', '+' || ? || ' seconds') "
+            r"WHERE link=? AND lease_owner=?".format(self.dbname), [lease, link, owner])
+        return self.cursor.rowcount > 0
+
+    def release(self, link, owner, delay=0):
+        self.cursor.execute(
+            r"UPDATE {} SET lease_owner=NULL, lease_expires=CASE WHEN ? > 0 THEN "
+            r"DATETIME('now', '+' || ? || ' seconds') END WHERE link=? AND lease_owner=?".format(
+                self.dbname), [delay, delay, link, owner])
+
+    def bucket(self, host):
+        self.cursor.execute(r"SELECT tokens, updated FROM {}_hosts WHERE host=?".format(self.dbname), [host])
+        row = self.cursor.fetchone()
+        return TokenBucket(*row) if row is not None else TokenBucket()
+
+    def save_bucket(self, host, bucket):
+        self.cursor.execute(r"INSERT OR REPLACE INTO {}_hosts (host, tokens, updated) VALUES (?,?,?)".format(
+            self.dbname), [host, bucket.tokens, bucket.updated])
+
+    def save_record_hash(self, link, record_hash):
+        self.cursor.execute(r"UPDATE {} SET record_hash=? WHERE link=?".format(
+            self.dbname), [record_hash, link])
+
+    def configure(self, link, key, value):
+        self.cursor.execute(r"UPDATE {} SET {}=? WHERE link=?".format(
+            self.dbname, key), [value, link])
 
     def select(self):
-        self.cursor.execute(r"SELECT * FROM {}".format(self.dbname))
-        self.db.commit()
+        self.cursor.execute(r"SELECT {} FROM {}".format(self.columns, self.dbname))
         return self.cursor.fetchall()
 
-    def select_fifo24(self):
+    def claim_due(self, owner, lease, limit=0):
         self.cursor.execute(
-            r"SELECT * FROM {} "
-            r"WHERE pause_date IS NULL AND "
-            r"(last_run IS NULL OR DATETIME('now', '-1 day') > last_run)".format(self.dbname))
-        self.db.commit()
+            r"UPDATE {0} SET lease_owner=?, lease_expires=DATETIME('now', '+' || ? || ' seconds') "
+            r"WHERE link IN (SELECT link FROM {0} "
+            r"WHERE pause_date IS NULL AND next_run_at <= CURRENT_TIMESTAMP "
+            r"AND (lease_expires IS NULL OR lease_expires <= CURRENT_TIMESTAMP) "
+            r"ORDER BY next_run_at LIMIT ?)".format(self.dbname), [owner, lease, limit or -1])
+        self.cursor.execute(r"SELECT {} FROM {} WHERE lease_owner=? ORDER BY next_run_at".format(
+            self.columns, self.dbname), [owner])
+        return self.cursor.fetchall()
+
+    def backlog(self):
+        self.cursor.execute(
+            r"SELECT COUNT(*), MAX(STRFTIME('%s', 'now') - STRFTIME('%s', next_run_at)) FROM {} "
+            r"WHERE pause_date IS NULL AND next_run_at <= CURRENT_TIMESTAMP".format(self.dbname))
+        return self.cursor.fetchone()
+
+    def upcoming(self, limit):
+        self.cursor.execute(
+            r"SELECT CAST(STRFTIME('%s', MAX(next_run_at, COALESCE(lease_expires, next_run_at))) "
+            r"AS INTEGER), link FROM {} WHERE pause_date IS NULL AND next_run_at IS NOT NULL "
+            r"ORDER BY next_run_at LIMIT ?".format(self.dbname), [limit])
         return self.cursor.fetchall()
 
+    def data_version(self):
+        self.cursor.execute(r"PRAGMA data_version")
+        return self.cursor.fetchone()[0]
+
     def get(self, link):
-        self.cursor.execute(r"SELECT * FROM {} WHERE link=?".format(
-            self.dbname), [link])
-        self.db.commit()
+        self.cursor.execute(r"SELECT {} FROM {} WHERE link=?".format(
+            self.columns, self.dbname), [link])
         return self.cursor.fetchone()
 
+    def select_summarized(self):
+        columns = ",".join(["s.{}".format(k) for k, _ in self.summary_fields])
+        self.cursor.execute(
+            r"SELECT {0}, {1} FROM {2} j LEFT JOIN {2}_summary s ON s.job_file=j.job_file".format(
+                ",".join(["j.{}".format(k) for k, _ in self.fields]), columns, self.dbname))
+        return [(row[:len(self.fields)], row[len(self.fields):]) for row in self.cursor.fetchall()]
+
+    def save_summary(self, job_file, name, fields, records, last_record, file_size, file_mtime):
+        values = [job_file, name, fields, records, last_record, file_size, file_mtime]
+        self.cursor.execute(r"INSERT OR REPLACE INTO {}_summary VALUES ({})".format(
+            self.dbname, ",".join(["?" for _ in values])), values)
+
+    def count_record(self, job_file, last_record, before, after):
+        self.cursor.execute(
+            r"UPDATE {}_summary SET records=records+1, last_record=?, file_size=?, file_mtime=? "
+            r"WHERE job_file=? AND file_size=? AND file_mtime=?".format(self.dbname),
+            [last_record, after[0], after[1], job_file, before[0], before[1]])
+        return self.cursor.rowcount > 0
+
+    def delete_summary(self, job_file):
+        self.cursor.execute(r"DELETE FROM {}_summary WHERE job_file=?".format(
+            self.dbname), [job_file])
+
+    def count_records(self, job_file):
+        self.cursor.execute(r"SELECT records FROM {}_summary WHERE job_file=?".format(
+            self.dbname), [job_file])
+        return self.cursor.fetchone()[0]
+
+    def enqueue(self, callback, job_file, offset, records, run_id=None):
+        self.cursor.execute(
+            r"INSERT INTO {}_outbox (callback, job_file, record_offset, records, run_id) VALUES (?,?,?,?,?)".format(
+                self.dbname), [callback, job_file, offset, json.dumps(records), run_id])
+
+    def outbox(self, limit):
+        self.cursor.execute(
+            r"SELECT id, callback, job_file, attempts, record_offset, records, run_id FROM {}_outbox "
+            r"WHERE next_attempt_at <= CURRENT_TIMESTAMP ORDER BY next_attempt_at, id LIMIT ?".format(
+                self.dbname), [limit])
+        return self.cursor.fetchall()
+
+    def delivered(self, ids):
+        for i in range(0, len(ids), Database.max_variables):
+            chunk = ids[i:i + Database.max_variables]
+            self.cursor.execute(r"DELETE FROM {}_outbox WHERE id IN ({})".format(
+                self.dbname, ",".join(["?" for _ in chunk])), chunk)
+
+    def postpone(self, event_id, delay):
+        self.cursor.execute(
+            r"UPDATE {}_outbox SET attempts=attempts+1, "
+            r"next_attempt_at=DATETIME('now', '+' || ? || ' seconds') WHERE id=?".format(
+                self.dbname), [delay, event_id])
+
+    def save_stats(self, link, dataplan, outcome, records, timings):
+        values = [link, dataplan, time.time(), outcome, records] + [timings.get(k) for k in STATS_STAGES]
+        self.cursor.execute(r"INSERT INTO {}_stats ({}) VALUES ({})".format(
+            self.dbname, ",".join([k for k, _ in self.stats_fields[1:]]), ",".join(["?" for _ in values])), values)
+        run_id = self.cursor.lastrowid
+        self.count("runs_" + outcome)
+        self.count("records_written", records)
+        return run_id
+
+    def called_back(self, run_ids):
+        now = time.time()
+        for i in range(0, len(run_ids), Database.max_variables):
+            chunk = run_ids[i:i + Database.max_variables]
+            self.cursor.execute(r"UPDATE {}_stats SET callback=? - finished_at WHERE id IN ({})".format(
+                self.dbname, ",".join(["?" for _ in chunk])), [now] + chunk)
+
+    def select_stats(self, since, dataplan=None):
+        self.cursor.execute(
+            r"SELECT link, dataplan, outcome, records, {} FROM {}_stats "
+            r"WHERE finished_at >= ? AND (? IS NULL OR dataplan=?)".format(
+                ",".join(STATS_STAGES), self.dbname), [since, dataplan, dataplan])
+        return self.cursor.fetchall()
+
+    def prune_stats(self, days):
+        self.cursor.execute(r"DELETE FROM {}_stats WHERE finished_at < ?".format(
+            self.dbname), [time.time() - days * 86400])
+
+    def count(self, name, value=1):
+        self.cursor.execute(r"INSERT OR IGNORE INTO {}_counters (name) VALUES (?)".format(
+            self.dbname), [name])
+        self.cursor.execute(r"UPDATE {}_counters SET value=value+? WHERE name=?".format(
+            self.dbname), [value, name])
+
+    def counters(self):
+        self.cursor.execute(r"SELECT name, value FROM {}_counters ORDER BY name".format(self.dbname))
+        return self.cursor.fetchall()
+
+    def pending_callbacks(self):
+        self.cursor.execute(r"SELECT COUNT(*) FROM {}_outbox".format(self.dbname))
+        return self.cursor.fetchone()[0]
+
     def pause_now(self, link):
         self.cursor.execute(r"UPDATE {} SET pause_date=CURRENT_TIMESTAMP WHERE link=?".format(
             self.dbname), [link])
-        self.db.commit()
 
     def resume_now(self, link):
         self.cursor.execute(r"UPDATE {} SET pause_date=NULL WHERE link=?".format(
             self.dbname), [link])
-        self.db.commit()
 
     def __enter__(self):
-        self.cursor = self.db.cursor()
-        self.initialize()
+        Database.lock.acquire()
+        try:
+            self.cursor = self.db.cursor()
+            self.initialize()
+        except Exception:
+            Database.lock.release()
+            raise
         return self
 
-    def __exit__(self, *args):
-        self.db.close()
+    def __exit__(self, exc_type, *args):
+        try:
+            if exc_type is None:
+                self.db.commit()
+            else:
+                self.db.rollback()
+        finally:
+            Database.lock.release()
+
+
+class Records(object):
+
+    def __init__(self, job_file):
+        self.job_file = job_file
+        self.filepath = records_file(job_file)
+
+    def stored(self):
+        with open(self.job_file) as fd:
+            return json.load(fd).get("records", [])
+
+    def append(self, record):
+        line = json.dumps(record, sort_keys=True, default=float)
+        with open(self.filepath, "a") as fd:
+            fd.write(line + "\n")
+            size = fd.tell()
+        if SEGMENT_SIZE > 0 and size >= SEGMENT_SIZE:
+            self.seal()
+
+    def segment_file(self, sequence):
+        return "{}.{}.jsonl.gz".format(os.path.splitext(self.job_file)[0], sequence)
+
+    def segments(self):
+        found = [self.segment_file(0)] if os.path.exists(self.segment_file(0)) else []
+        sequence = 1
+        while os.path.exists(self.segment_file(sequence)):
+            found.append(self.segment_file(sequence))
+            sequence += 1
+        return found
+
+    def seal(self):
+        segment = self.segment_file(len([f for f in self.segments() if f != self.segment_file(0)]) + 1)
+        with open(self.filepath, "rb") as src, gzip.open(segment + ".tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.rename(segment + ".tmp", segment)
+        os.remove(self.filepath)
+
+    def stat(self):
+        size, mtime = 0, os.path.getmtime(self.job_file)
+        for filepath in self.segments() + [self.filepath]:
+            if os.path.exists(filepath):
+                st = os.stat(filepath)
+                size, mtime = size + st.st_size, max(mtime, st.st_mtime)
+        return size, mtime
+
+    def lines(self):
+        for segment in self.segments():
+            with gzip.open(segment, "rb") as fd:
+                for line in fd:
+                    if line.strip():
+                        yield line
+        if os.path.exists(self.filepath):
+            with open(self.filepath) as fd:
+                for line in fd:
+                    if line.strip():
+                        yield line
+
+    def summarize(self, jobs):
+        file_size, file_mtime = self.stat()
+        data = load_plan(self.job_file)
+        name = data.get("meta", {}).get("name", "n/a")
+        fields = ", ".join(data.get("declare", {}).keys())
+        stored = data.get("records", [])
+        total, last = len(stored), stored[-1] if len(stored) > 0 else None
+        last_line = None
+        for line in self.lines():
+            total += 1
+            last_line = line
+        if last_line is not None:
+            last = json.loads(last_line)
+        last_record = record_time(last) if last is not None else None
+        jobs.save_summary(self.job_file, name, fields, total, last_record, file_size, file_mtime)
+        return name, fields, total, last_record
+
+    def migrate(self):
+        with open(self.job_file) as fd:
+            data = json.load(fd)
+        records = data.get("records", [])
+        if len(records) == 0:
+            return 0
+        if len(self.segments()) > 0:
+            tmp_file = self.segment_file(0) + ".tmp"  # records older than all segments
+            with gzip.open(tmp_file, "wb") as fd:
+                for record in records:
+                    fd.write(json.dumps(record, sort_keys=True, default=float) + "\n")
+            os.rename(tmp_file, self.segment_file(0))
+        else:
+            tmp_file = self.filepath + ".tmp"
+            with open(tmp_file, "w") as fd:
+                for record in records:
+                    fd.write(json.dumps(record, sort_keys=True, default=float) + "\n")
+                if os.path.exists(self.filepath):
+                    with open(self.filepath) as segment:
+                        for line in segment:
+                            fd.write(line)
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.rename(tmp_file, self.filepath)
+        data.update({"records": []})
+        tmp_file = self.job_file + ".tmp"
+        with open(tmp_file, "w") as fd:
+            json.dump(data, fd, separators=(",", ":"))
+        os.rename(tmp_file, self.job_file)
+        return len(records)
+
+    def compact(self, keep=None, days=None, downsample=None):
+        self.migrate()
+        segments = self.segments()
+        if len(segments) == 0 and not os.path.exists(self.filepath):
+            return 0, 0, None, 0.0
+        started, total = time.time(), 0
+        for record in self:
+            total += 1
+        parse_time = time.time() - started
+        cutoff = time.time() - days * 86400 if days is not None else None
+        archive_file = self.archive_file()
+        tmp_file, periods, last, expand = self.filepath + ".tmp", set(), None, False
+        kept, archived = 0, 0
+        with open(tmp_file, "w") as fd, gzip.open(archive_file + ".tmp", "wb") as archive:
+            for index, record in enumerate(self):
+                created = record_time(record)
+                retain = (keep is not None and index >= total - keep) or \
+                    (cutoff is not None and created is not None and created >= cutoff)
+                if not retain and downsample is not None and not is_heartbeat(record) and created is not None:
+                    period = self.period(created, downsample)
+                    retain = period not in periods
+                    periods.add(period)
+                if not retain:
+                    archive.write(json.dumps(record, sort_keys=True, default=float) + "\n")
+                    archived += 1
+                elif is_heartbeat(record) and expand and last is not None:
+                    fd.write(json.dumps(dict(last, _datetime=record.get("_datetime")), sort_keys=True, default=float) + "\n")
+                    kept += 1  # the record it repeats was archived
+                    expand = False
+                else:
+                    fd.write(json.dumps(record, sort_keys=True, default=float) + "\n")
+                    kept += 1
+                if not is_heartbeat(record):
+                    last, expand = record, not retain
+            fd.flush()
+            os.fsync(fd.fileno())
+        if archived > 0:
+            os.rename(archive_file + ".tmp", archive_file)
+        else:
+            os.remove(archive_file + ".tmp")
+            archive_file = None
+        os.rename(tmp_file, self.filepath)
+        for segment in segments:
+            os.remove(segment)
+        return total, archived, archive_file, parse_time
+
+    def archives(self):
+        directory, name = os.path.split(os.path.splitext(self.job_file)[0])
+        return sorted([os.path.join(directory, f) for f in os.listdir(directory or ".")
+                       if f.startswith(name + ".archive.") and f.endswith(".jsonl.gz")])
+
+    def archive_file(self):
+        base, sequence = "{}.archive.{}".format(os.path.splitext(self.job_file)[0], int(time.time())), 0
+        archive_file = base + ".jsonl.gz"
+        while os.path.exists(archive_file) or os.path.exists(archive_file + ".tmp"):
+            sequence += 1
+            archive_file = "{}-{}.jsonl.gz".format(base, sequence)
+        return archive_file
+
+    def period(self, created, downsample):
+        moment = datetime.date.fromtimestamp(created)
+        if downsample == "week":
+            return moment.isocalendar()[:2]
+        return moment
+
+    def __iter__(self):
+        for record in self.stored():
+            yield record
+        for line in self.lines():
+            yield json.loads(line)
+
+
+class Columnar(object):
+    """Chunked columnar export of records.
+
+    All numbers are little-endian. The file starts with a header:
+        magic    4 bytes  "HAPC"
+        version  uint8    1
+        columns  uint16   number of columns
+        then for each column:
+            length   uint16   length of column name
+            name     bytes    UTF-8 column name
+            type     1 byte   d (float64), q (int64), b (int8) or s (string)
+    The header is followed by chunks of at most EXPORT_CHUNK rows:
+        rows     uint32   number of rows in chunk (0 marks the end of file)
+        then for each column:
+            nulls    rows bytes    1 for null values, 0 otherwise
+            values   d, q, b       rows packed values (0 for nulls)
+                     s             rows uint32 byte lengths, then UTF-8 data
+    Declared datatypes map to column types:
+        d        decimal, percentage, float, double
+        q        integer, number
+        b        boolean
+        s        any other datatype
+    The _datetime column is exported as float64 UNIX timestamp.
+    """
+
+    magic, version = b"HAPC", 1
+    types = {
+        "datetime": "d",
+        "decimal": "d",
+        "percentage": "d",
+        "float": "d",
+        "double": "d",
+        "integer": "q",
+        "number": "q",
+        "boolean": "b",
+    }
+
+    def __init__(self, fd, columns, chunk=None):
+        self.fd = fd
+        self.chunk = chunk or EXPORT_CHUNK
+        self.columns = [(name, self.types.get(declared, "s")) for name, declared in columns]
+
+    def convert(self, value, datatype):
+        if value is None:
+            return None
+        try:
+            if datatype == "d":
+                return float(value)
+            elif datatype == "q":
+                value = int(value)
+                return value if -(1 << 63) <= value < (1 << 63) else None
+            elif datatype == "b":
+                return 1 if value else 0
+            if isinstance(value, str):
+                return value
+            return unicode(value).encode("utf-8")
+        except (TypeError, ValueError):
+            return None
+
+    def write_header(self):
+        self.fd.write(self.magic)
+        self.fd.write(struct.pack("<BH", self.version, len(self.columns)))
+        for name, datatype in self.columns:
+            name = name.encode("utf-8")
+            self.fd.write(struct.pack("<H", len(name)))
+            self.fd.write(name)
+            self.fd.write(datatype)
+
+    def write_chunk(self, rows):
+        self.fd.write(struct.pack("<I", len(rows)))
+        for index, (_, datatype) in enumerate(self.columns):
+            values = [row[index] for row in rows]
+            nulls = array.array("B", [1 if v is None else 0 for v in values])
+            self.fd.write(nulls.tostring())
+            if datatype == "s":
+                values = [v or b"" for v in values]
+                self.fd.write(struct.pack("<{}I".format(len(values)), *[len(v) for v in values]))
+                self.fd.write(b"".join(values))
+            else:
+                values = [0 if v is None else v for v in values]
+                self.fd.write(struct.pack("<{}{}".format(len(values), datatype), *values))
+
+    def write(self, records):
+        self.write_header()
+        rows, exported = [], 0
+        for record in records:
+            row = []
+            for name, datatype in self.columns:
+                if name == "_datetime":
+                    row.append(record_time(record))
+                else:
+                    row.append(self.convert(record.get(name), datatype))
+            rows.append(row)
+            if len(rows) == self.chunk:
+                self.write_chunk(rows)
+                exported += len(rows)
+                rows = []
+        if len(rows) > 0:
+            self.write_chunk(rows)
+            exported += len(rows)
+        self.fd.write(struct.pack("<I", 0))
+        return exported
+
+
+class Stats(object):
+
+    quantiles = (0.5, 0.95, 0.99)
+
+    def __init__(self, jobs, hours=24, dataplan=None):
+        self.jobs = jobs
+        self.hours = hours
+        self.rows = jobs.select_stats(time.time() - hours * 3600, dataplan)
+
+    def dataplans(self):
+        groups = collections.OrderedDict()
+        for row in sorted(self.rows, key=lambda row: row[1]):
+            _, dataplan, outcome, records = row[:4]
+            group = groups.setdefault(dataplan, {
+                "runs": 0, "failed": 0, "records": 0,
+                "stages": dict([(stage, []) for stage in STATS_STAGES]),
+            })
+            group["runs"] += 1
+            group["failed"] += int(outcome == "failed")
+            group["records"] += records or 0
+            for stage, value in zip(STATS_STAGES, row[4:]):
+                if value is not None:
+                    group["stages"][stage].append(value)
+        for group in groups.itervalues():
+            for values in group["stages"].itervalues():
+                values.sort()
+        return groups
+
+    def slowest(self, limit):
+        totals = {}
+        for row in self.rows:
+            total = row[4 + STATS_STAGES.index("total")]
+            if total is not None:
+                totals.setdefault(row[0], []).append(total)
+        ranked = [(percentile(sorted(values), 0.95), len(values), link) for link, values in totals.iteritems()]
+        return sorted(ranked, reverse=True)[:limit]
+
+    def textfile(self, filepath):
+        counters = dict(self.jobs.counters())
+        depth, age = self.jobs.backlog()
+        lines = [
+            u"# HELP hap_job_runs_total Runs of background jobs by outcome.",
+            u"# TYPE hap_job_runs_total counter",
+        ]
+        for outcome in ("stored", "unchanged", "not_modified", "failed"):
+            lines.append(u'hap_job_runs_total{{outcome="{}"}} {}'.format(outcome, counters.get("runs_" + outcome, 0)))
+        lines.extend([
+            u"# HELP hap_records_written_total Records written by background jobs.",
+            u"# TYPE hap_records_written_total counter",
+            u"hap_records_written_total {}".format(counters.get("records_written", 0)),
+            u"# HELP hap_jobs_due Background jobs waiting to run.",
+            u"# TYPE hap_jobs_due gauge",
+            u"hap_jobs_due {}".format(depth or 0),
+            u"# HELP hap_jobs_due_oldest_seconds Seconds the oldest due job has been waiting.",
+            u"# TYPE hap_jobs_due_oldest_seconds gauge",
+            u"hap_jobs_due_oldest_seconds {}".format(age or 0),
+            u"# HELP hap_callbacks_pending Callbacks waiting to be delivered.",
+            u"# TYPE hap_callbacks_pending gauge",
+            u"hap_callbacks_pending {}".format(self.jobs.pending_callbacks()),
+            u"# HELP hap_job_stage_seconds Seconds spent in each stage by runs of the last {} hour(s).".format(self.hours),
+            u"# TYPE hap_job_stage_seconds summary",
+        ])
+        for dataplan, group in self.dataplans().iteritems():
+            for stage in STATS_STAGES:
+                values = group["stages"][stage]
+                if len(values) == 0:
+                    continue
+                labels = u'dataplan="{}",stage="{}"'.format(prometheus_label(dataplan), stage)
+                for rank in self.quantiles:
+                    lines.append(u'hap_job_stage_seconds{{{},quantile="{}"}} {:.6f}'.format(
+                        labels, rank, percentile(values, rank)))
+                lines.append(u"hap_job_stage_seconds_sum{{{}}} {:.6f}".format(labels, sum(values)))
+                lines.append(u"hap_job_stage_seconds_count{{{}}} {}".format(labels, len(values)))
+        with io.open(filepath + ".tmp", "w", encoding="utf-8") as fd:
+            fd.write(u"\n".join(lines) + u"\n")
+        os.rename(filepath + ".tmp", filepath)
 
 
 class Console(object):
 
+    export_formats = {
+        "tsv": lambda line: u"\t".join(line) + u"\n",
+        "csv": lambda line: u",".join([quote_csv(cell) for cell in line]) + u"\n",
+    }
+
+    settings = {
+        "store": ("all", "changes"),
+        "timeout": int,
+    }
+
     def parse_job(self, job, retval):
         return parse_job(job, retval)
 
@@ -206,31 +1170,46 @@ class Console(object):
             with Jobs() as jobs:
                 index = 1
                 print("Listing jobs...")
-                for job in jobs.select():
+                for job, summary in jobs.select_summarized():
                     print()
                     start_date = self.parse_job(job, "start_date")
                     pause_date = self.parse_job(job, "pause_date")
                     last_run = self.parse_job(job, "last_run")
+                    next_run = self.parse_job(job, "next_run_at")
+                    interval = self.parse_job(job, "interval")
                     link = self.parse_job(job, "link")
                     dp_file = self.parse_job(job, "job_file")
-                    with open(dp_file) as fd:
-                        dataplan = json.load(fd)
-                        dp_name = dataplan.get("meta", {}).get("name", "n/a")
-                        records = dataplan.get("records", [])
-                        keys = ", ".join(dataplan.get("declare", {}).keys())
+                    dp_name, keys, records, last_record, file_size, file_mtime = summary[1:]
+                    records_store = Records(dp_file)
+                    if (file_size, file_mtime) != records_store.stat():
+                        dp_name, keys, records, last_record = records_store.summarize(jobs)
                     print("{:>3}) {}".format(index, link))
-                    if pause_date is None:
+                    status = self.parse_job(job, "status")
+                    if pause_date is None and status == "dead":
+                        print("   * \033[91mDead\033[00m after {} failure(s) (last run on {}): {}".format(
+                            self.parse_job(job, "failures"), last_run, self.parse_job(job, "last_error")))
+                    elif pause_date is None and status == "retry":
+                        print("   * \033[93mFailing\033[00m {} time(s) (last run on {}, retry on {}): {}".format(
+                            self.parse_job(job, "failures"), last_run, next_run, self.parse_job(job, "last_error")))
+                    elif pause_date is None:
                         if last_run is None:
                             print("   * \033[93mQueued\033[00m (never performed)".format(start_date))
                         else:
-                            print("   * \033[92mActive\033[00m (last run on {})".format(last_run))
+                            print("   * \033[92mActive\033[00m (last run on {}, next run on {})".format(last_run, next_run))
                     else:
                         if last_run is None:
                             print("   * \033[91mPaused\033[00m since {} (never performed)".format(pause_date))
                         else:
                             print("   * \033[91mPaused\033[00m since {} (last run on {})".format(pause_date, last_run))
-                    print("   * Collected {} record(s) with the following fields: {}".format(len(records), keys))
-                    print('   * Registered on {} with "{}" dataplan'.format(start_date, dp_name))
+                    print("   * Collected {} record(s) with the following fields: {}".format(records, keys))
+                    if last_record is not None:
+                        print("   * Last record collected on {}".format(format_datetime(last_record)))
+                    if self.parse_job(job, "store") == "changes":
+                        print("   * Stores records only when fields change")
+                    if self.parse_job(job, "timeout") is not None:
+                        print("   * Times out after {} second(s)".format(self.parse_job(job, "timeout")))
+                    print('   * Registered on {} with "{}" dataplan to run every {} hour(s)'.format(
+                        start_date, dp_name, interval))
                     index += 1
                 if not index > 1:
                     print("No jobs found")
@@ -238,56 +1217,171 @@ class Console(object):
             raise SystemExit("Unexpected error while listing jobs: {}".format(e))
 
     def handle_dump(self, link, *args):
-        """dump LINK"""
-        write_line = lambda line: "\t".join(line)
+        """dump LINK [--since DATE] [--until DATE] [--format tsv|csv|columnar] [--output PATH] [--expand]"""
+        try:
+            flags, _ = getopt.getopt(args, "", ["since=", "until=", "format=", "output=", "expand"])
+        except getopt.GetoptError as e:
+            raise SystemExit("Unsupported flag: {}".format(e))
+        flags = dict(flags)
+        since, until = flags.get("--since"), flags.get("--until")
+        if since is not None:
+            since = parse_datetime(since)
+            if since is None:
+                raise SystemExit("Unsupported date for --since (use YYYY-MM-DD [HH:MM:SS])")
+        if until is not None:
+            until = parse_datetime(until)
+            if until is None:
+                raise SystemExit("Unsupported date for --until (use YYYY-MM-DD [HH:MM:SS])")
+        export_format = flags.get("--format", "tsv")
+        if export_format != "columnar" and export_format not in self.export_formats:
+            raise SystemExit("Unsupported export format {}".format(export_format))
+        exportpath = flags.get("--output", "records_{}.{}".format(int(time.time()), export_format))
         try:
             with Jobs() as jobs:
                 job_file = self.parse_job(jobs.get(link), "job_file")
-            with open(job_file) as fd:
-                data = json.load(fd)
-                declared_keys = data.get("declare", {})
-                records = data.get("records", [])
-            ordonated_columns = [("_datetime", "Date and Time")]
-            for k in declared_keys.iterkeys():
-                ordonated_columns.append((k, k.replace("_", " ").capitalize()))
-            headers = [x[-1] for x in ordonated_columns]
-            ordonated_rows = [write_line(headers)]
-            for each in records:
-                row = []
-                for c, _ in ordonated_columns:
-                    cell = unicode(each.get(c, "n/a"))
-                    row.append(cell)
-                ordonated_rows.append(write_line(row))
-            exportpath = "records_{}.tsv".format(int(time.time()))
-            with io.open(exportpath, "w", encoding="utf8") as fd:
-                fd.write("\n".join(ordonated_rows))
-            print("Exported {} record(s) to {}".format(len(records), exportpath))
+            declared_keys = load_plan(job_file).get("declare", {})
+            records = self.expand_records(Records(job_file), "--expand" in flags)
+            records = self.filter_records(records, since, until)
+            if export_format == "columnar":
+                columns = [("_datetime", "datetime")] + declared_keys.items()
+                if exportpath == "-":
+                    fd = io.open(sys.stdout.fileno(), "wb", closefd=False)
+                else:
+                    fd = io.open(exportpath, "wb", buffering=EXPORT_BUFFER)
+                with fd:
+                    exported = Columnar(fd, columns).write(records)
+            else:
+                if exportpath == "-":
+                    fd = io.open(sys.stdout.fileno(), "w", encoding="utf8", closefd=False)
+                else:
+                    fd = io.open(exportpath, "w", encoding="utf8", buffering=EXPORT_BUFFER)
+                with fd:
+                    exported = self.export_text(fd, records, declared_keys, export_format)
+            if exportpath == "-":
+                print("Exported {} record(s) to stdout".format(exported), file=sys.stderr)
+            else:
+                print("Exported {} record(s) to {}".format(exported, exportpath))
         except Exception as e:
             raise SystemExit("Failed to export jobs because: {}".format(e))
 
-    def handle_join(self, dataplan, link, *args):
-        """join DATAPLAN LINK"""
+    def expand_records(self, records, expand=False):
+        last = None
+        for each in records:
+            if not is_heartbeat(each):
+                last = each
+                yield each
+            elif expand and last is not None:
+                yield dict(last, _datetime=each.get("_datetime"))
+
+    def filter_records(self, records, since=None, until=None):
+        for each in records:
+            if since is not None or until is not None:
+                created = record_time(each)
+                if created is None:
+                    continue
+                if since is not None and created < since:
+                    continue
+                if until is not None and created > until:
+                    continue
+            yield each
+
+    def export_text(self, fd, records, declared_keys, export_format):
+        write_line = self.export_formats.get(export_format)
+        ordonated_columns = [("_datetime", "Date and Time")]
+        for k in declared_keys.iterkeys():
+            ordonated_columns.append((k, k.replace("_", " ").capitalize()))
+        headers = [x[-1] for x in ordonated_columns]
+        fd.write(write_line(headers))
+        exported = 0
+        for each in records:
+            row = []
+            for c, _ in ordonated_columns:
+                if c == "_datetime":
+                    cell = format_datetime(each.get(c))
+                else:
+                    cell = unicode(each.get(c, "n/a"))
+                row.append(cell)
+            fd.write(write_line(row))
+            exported += 1
+        return exported
+
+    def parse_interval(self, interval):
+        try:
+            interval = int(interval)
+        except ValueError:
+            raise SystemExit("Unsupported interval {}".format(interval))
+        if interval < 1:
+            raise SystemExit("Interval must be at least one hour")
+        return interval
+
+    def load_dataplan(self, dataplan):
         if not dataplan.endswith(".json"):
             dataplan += ".json"
         if not self.has_dataplan(dataplan):
             raise SystemExit("Unsupported dataplan {}".format(dataplan))
         with open(os.path.join(DATAPLANS_DIR, dataplan), "r") as fd:
-            data = json.load(fd)
-            data.update({"link": link})
-            data.update({"records": []})
-        now = int(time.time())
-        job_file = os.path.join(JOBS_DIRECTORY, "{}_{}".format(dataplan, now))
-        if not job_file.endswith(".json"):
-            job_file += ".json"
-        with open(job_file, "w") as fd:
-            json.dump(data, fd, indent=4)
+            master = save_master(json.load(fd))
+        return dataplan, master
+
+    def write_job(self, dataplan, master, link):
+        link_hash = hashlib.sha1(link.encode("utf-8")).hexdigest()[:8]
+        job_file = os.path.join(JOBS_DIRECTORY, "{}_{}_{}.json".format(dataplan, int(time.time()), link_hash))
+        write_reference(job_file, master, {"link": link})
+        return job_file
+
+    def read_links(self, filepath):
+        fd = sys.stdin if filepath == "-" else open(filepath, "r")
+        try:
+            links = collections.OrderedDict()
+            for line in fd:
+                line = line.strip().decode("utf-8")
+                if line and not line.startswith("#"):
+                    links[line] = True
+            return links.keys()
+        finally:
+            fd is not sys.stdin and fd.close()
+
+    def handle_join(self, dataplan, link, *args):
+        """join DATAPLAN LINK|--from FILE|- [HOURS]"""
+        if link == "--from" and len(args) > 0:
+            return self.join_many(dataplan, *args)
+        elif link == "--from":
+            raise SystemExit("Usage: jobs {}".format(self.handle_join.__doc__))
+        interval = self.parse_interval(args[0] if len(args) > 0 else 24)
+        dataplan, master = self.load_dataplan(dataplan)
+        job_file = self.write_job(dataplan, master, link)
         try:
             with Jobs() as jobs:
-                jobs.insert(dataplan, job_file, link)
+                jobs.insert(dataplan, job_file, link, interval)
             print("Successfully added new background job: {}".format(job_file))
         except Exception as e:
             raise SystemExit("Failed to add background job because: {}".format(e))
 
+    def join_many(self, dataplan, filepath, interval=24, *args):
+        interval = self.parse_interval(interval)
+        dataplan, master = self.load_dataplan(dataplan)
+        try:
+            links = self.read_links(filepath)
+        except IOError as e:
+            raise SystemExit("Cannot read links because: {}".format(e))
+        started, rows = time.time(), []
+        try:
+            with Jobs() as jobs:
+                existing = jobs.links()
+                for link in links:
+                    if link not in existing:
+                        rows.append((dataplan, self.write_job(dataplan, master, link), link, interval))
+                jobs.insert_many(rows)
+        except Exception as e:
+            for row in rows:
+                os.path.exists(row[1]) and os.remove(row[1])
+            raise SystemExit("Failed to add background jobs because: {}".format(e))
+        elapsed = time.time() - started
+        print("Successfully added {} new background job(s) in {:.2f}s ({:.2f} jobs/s), skipped {} known link(s)".format(
+            len(rows), elapsed, len(rows) / max(elapsed, 0.001), len(links) - len(rows)))
+        if len(rows) > 0:
+            print("First runs are queued for the next run of the manager")
+
     def handle_purge(self, link, *args):
         """purge LINK"""
         if not self.has_job(link):
@@ -296,6 +1390,11 @@ class Console(object):
             with Jobs() as jobs:
                 job_file = self.parse_job(jobs.get(link), "job_file")
                 os.remove(job_file)
+                if os.path.exists(records_file(job_file)):
+                    os.remove(records_file(job_file))
+                for archive_file in Records(job_file).segments() + Records(job_file).archives():
+                    os.remove(archive_file)
+                jobs.delete_summary(job_file)
                 jobs.delete(link)
             print("Successfully removed background job")
         except Exception as e:
@@ -317,59 +1416,795 @@ class Console(object):
         """resume LINK"""
         try:
             with Jobs() as jobs:
-                pause_date = self.parse_job(jobs.get(link), "pause_date")
-                if pause_date is None:
+                job = jobs.get(link)
+                pause_date = self.parse_job(job, "pause_date")
+                if self.parse_job(job, "status") == "dead":
+                    jobs.revive(link)
+                elif pause_date is None:
                     raise SystemExit("Job is already running")
-                jobs.resume_now(link)
+                if pause_date is not None:
+                    jobs.resume_now(link)
             print("Successfully resumed background job")
         except Exception as e:
             raise SystemExit("Failed to resume job because: {}".format(e))
 
+    def parse_setting(self, key, value):
+        allowed = self.settings.get(key, ())
+        if not callable(allowed):
+            return value if value in allowed else None
+        try:
+            return allowed(value)
+        except ValueError:
+            return None
+
+    def handle_configure(self, link, key, value):
+        """configure LINK store all|changes|timeout SECONDS"""
+        value = self.parse_setting(key, value)
+        if value is None:
+            raise SystemExit("Usage: jobs {}".format(self.handle_configure.__doc__))
+        try:
+            with Jobs() as jobs:
+                if jobs.get(link) is None:
+                    raise SystemExit("Job not found")
+                jobs.configure(link, key, value)
+            print("Successfully configured background job")
+        except Exception as e:
+            raise SystemExit("Failed to configure job because: {}".format(e))
+
+    def handle_compact(self, *args):
+        """compact [LINK] [--keep N] [--days N] [--downsample day|week]"""
+        try:
+            flags, links = getopt.gnu_getopt(args, "", ["keep=", "days=", "downsample="])
+            flags = dict(flags)
+            keep, days = flags.get("--keep"), flags.get("--days")
+            keep = int(keep) if keep is not None else None
+            days = int(days) if days is not None else None
+        except (getopt.GetoptError, ValueError) as e:
+            raise SystemExit("Unsupported flag: {}".format(e))
+        downsample = flags.get("--downsample")
+        if downsample not in (None, "day", "week"):
+            raise SystemExit("Unsupported downsample period {} (use day or week)".format(downsample))
+        if keep is None and days is None and downsample is None:
+            raise SystemExit("Usage: jobs {}".format(self.handle_compact.__doc__))
+        owner = "compact:{}:{}".format(socket.gethostname(), os.getpid())
+        try:
+            with Jobs() as jobs:
+                selected = [j for j in jobs.select() if len(links) == 0 or self.parse_job(j, "link") in links]
+            if len(selected) == 0:
+                raise SystemExit("No jobs found")
+            reclaimed, compacted = 0, 0
+            for j in selected:
+                link, job_file = self.parse_job(j, "link"), self.parse_job(j, "job_file")
+                with Jobs() as jobs:
+                    if not jobs.lease(link, owner, LEASE_TIME):
+                        print("Skipped {} (job is running, try again later)".format(link))
+                        continue
+                try:
+                    records = Records(job_file)
+                    size = os.path.getsize(job_file) + records.stat()[0]
+                    total, archived, archive_file, parse_time = records.compact(keep, days, downsample)
+                    started = time.time()
+                    for record in records:
+                        pass
+                    compacted_parse_time = time.time() - started
+                    freed = size - os.path.getsize(job_file) - records.stat()[0]
+                    reclaimed += freed
+                    compacted += 1
+                finally:
+                    with Jobs() as jobs:
+                        jobs.release(link, owner)
+                        records.summarize(jobs)
+                print("Compacted {}: kept {} of {} record(s), reclaimed {} bytes, parse time {:.1f}ms -> {:.1f}ms".format(
+                    link, total - archived, total, freed, parse_time * 1000, compacted_parse_time * 1000))
+                if archive_file is not None:
+                    print("Archived {} record(s) to {}".format(archived, archive_file))
+            print("Successfully compacted {} job(s) and reclaimed {} bytes".format(compacted, reclaimed))
+        except Exception as e:
+            raise SystemExit("Failed to compact jobs because: {}".format(e))
+
+    def handle_migrate(self, *args):
+        """migrate"""
+        owner = "migrate:{}:{}".format(socket.gethostname(), os.getpid())
+        try:
+            with Jobs() as jobs:
+                selected = jobs.select()
+            total, referenced, migrated = 0, 0, 0
+            for j in selected:
+                link, job_file = self.parse_job(j, "link"), self.parse_job(j, "job_file")
+                with Jobs() as jobs:
+                    if not jobs.lease(link, owner, LEASE_TIME):
+                        print("Skipped {} (job is running, try again later)".format(link))
+                        continue
+                try:
+                    moved = Records(job_file).migrate()
+                    if moved > 0:
+                        print("Moved {} record(s) from {}".format(moved, job_file))
+                    total += moved
+                    with open(job_file) as fd:
+                        data = json.load(fd)
+                    if "master" not in data:
+                        write_reference(job_file, save_master(data), {"link": data.get("link")})
+                        referenced += 1
+                    migrated += 1
+                finally:
+                    with Jobs() as jobs:
+                        jobs.release(link, owner)
+            print("Successfully migrated {} record(s) of {} job(s)".format(total, migrated))
+            if referenced > 0:
+                print("Replaced {} copied dataplan(s) with references to master snapshots".format(referenced))
+        except Exception as e:
+            raise SystemExit("Failed to migrate records because: {}".format(e))
+
+    def handle_stats(self, *args):
+        """stats [DATAPLAN] [--hours N] [--slowest N] [--prometheus PATH]"""
+        try:
+            flags, dataplans = getopt.gnu_getopt(args, "", ["hours=", "slowest=", "prometheus="])
+            flags = dict(flags)
+            hours, slowest = int(flags.get("--hours", 24)), int(flags.get("--slowest", 10))
+        except (getopt.GetoptError, ValueError) as e:
+            raise SystemExit("Unsupported flag: {}".format(e))
+        dataplan = dataplans[0] if len(dataplans) > 0 else None
+        if dataplan is not None and not dataplan.endswith(".json"):
+            dataplan += ".json"
+        try:
+            with Jobs() as jobs:
+                stats = Stats(jobs, hours, dataplan)
+                if "--prometheus" in flags:
+                    stats.textfile(flags["--prometheus"])
+                    print("Successfully exported statistics to {}".format(flags["--prometheus"]))
+                    return
+                counters = dict(jobs.counters())
+            print("Statistics of job runs in the last {} hour(s):".format(hours))
+            for name, group in stats.dataplans().iteritems():
+                print()
+                print("# {}: {} run(s), {} failed, {} record(s) written".format(
+                    name, group["runs"], group["failed"], group["records"]))
+                print("  {:<8} | {:>9} | {:>9} | {:>9} | {:>9}".format("Stage", "p50", "p95", "p99", "max"))
+                print("  " + "=" * 9 + "|" + "|".join(["=" * 11] * 4))
+                for stage in STATS_STAGES:
+                    values = group["stages"][stage]
+                    if len(values) > 0:
+                        cells = [percentile(values, rank) for rank in Stats.quantiles] + [values[-1]]
+                        print("  {:<8} | {}".format(stage, " | ".join(["{:>8.3f}s".format(v) for v in cells])))
+            ranked = stats.slowest(slowest)
+            if len(ranked) > 0:
+                print()
+                print("Slowest links (p95 of total time):")
+                for total, runs, link in ranked:
+                    print("  {:>8.3f}s in {} run(s) of {}".format(total, runs, link))
+            print()
+            print("Since the first run: {} stored, {} unchanged, {} not modified, {} failed, {} record(s) written".format(
+                *[counters.get(k, 0) for k in ("runs_stored", "runs_unchanged", "runs_not_modified",
+                                               "runs_failed", "records_written")]))
+        except Exception as e:
+            raise SystemExit("Failed to read statistics because: {}".format(e))
+
+    def handle_rebase(self, dataplan, *args):
+        """rebase DATAPLAN"""
+        dataplan, master = self.load_dataplan(dataplan)
+        owner = "rebase:{}:{}".format(socket.gethostname(), os.getpid())
+        try:
+            rebased = 0
+            with Jobs() as jobs:
+                selected = [j for j in jobs.select() if self.parse_job(j, "dataplan") == dataplan]
+            for j in selected:
+                link, job_file = self.parse_job(j, "link"), self.parse_job(j, "job_file")
+                with Jobs() as jobs:
+                    if not jobs.lease(link, owner, LEASE_TIME):
+                        print("Skipped {} (job is running, try again later)".format(link))
+                        continue
+                try:
+                    Records(job_file).migrate()
+                    with open(job_file) as fd:
+                        data = json.load(fd)
+                    if data.get("master") == master:
+                        continue
+                    overrides = data if "master" in data else {"link": data.get("link")}
+                    write_reference(job_file, master, dict([(k, v) for k, v in overrides.items() if k != "records"]))
+                    rebased += 1
+                finally:
+                    with Jobs() as jobs:
+                        jobs.release(link, owner)
+            with Jobs() as jobs:
+                jobs.clear_validators(dataplan)
+            print("Successfully rebased {} job(s) on {} ({})".format(rebased, dataplan, master[:12]))
+        except Exception as e:
+            raise SystemExit("Failed to rebase jobs because: {}".format(e))
+
+
+class TokenBucket(object):
+
+    def __init__(self, tokens=None, updated=None, rate=HOST_RATE, burst=HOST_BURST):
+        self.rate = rate / 60.0
+        self.burst = burst
+        self.tokens = float(burst if tokens is None else tokens)
+        self.updated = updated or time.time()
+
+    def delay(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + max(now - self.updated, 0) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    # tokens can be taken ahead of time, the bucket refills before lending more
+    def take(self):
+        self.tokens -= 1
+
+
+class Pool(object):
+
+    def __init__(self, workers=WORKERS, per_host=WORKERS_PER_HOST, slots=None):
+        self.workers = workers
+        self.per_host = per_host
+        self.slots = slots if slots is not None else {}  # host -> times jobs may start at
+        self.lock = threading.Condition()
+        self.queues = collections.OrderedDict()
+        self.running = collections.defaultdict(int)
+        self.pending = 0
+
+    def submit(self, link, func, *args):
+        host = urlparse(link).netloc
+        with self.lock:
+            self.queues.setdefault(host, collections.deque()).append((func, args))
+            self.pending += 1
+
+    def next_job(self):
+        wait = None
+        for host, queue in self.queues.items():
+            if self.running[host] >= self.per_host:
+                continue
+            slots = self.slots.get(host)
+            if slots:
+                delay = slots[0] - time.time()
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                slots.popleft()
+            job = queue.popleft()
+            if len(queue) > 0:
+                self.queues[host] = self.queues.pop(host)  # round-robin hosts
+            else:
+                del self.queues[host]
+            return host, job, None
+        return None, None, wait
+
+    def work(self):
+        while True:
+            with self.lock:
+                host, job, wait = self.next_job()
+                while job is None:
+                    if self.pending == 0:
+                        return
+                    self.lock.wait(wait)
+                    host, job, wait = self.next_job()
+                self.running[host] += 1
+                self.pending -= 1
+            func, args = job
+            try:
+                func(*args)
+            except Exception as e:
+                print("Unexpected error while running job: {}".format(e))
+            finally:
+                with self.lock:
+                    self.running[host] -= 1
+                    self.lock.notify_all()
+
+    def join(self):
+        started = time.time()
+        threads = [threading.Thread(target=self.work) for _ in range(min(self.workers, self.pending))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return time.time() - started
+
+
+class TimeoutTransport(xmlrpclib.Transport):
+
+    def make_connection(self, host):
+        conn = xmlrpclib.Transport.make_connection(self, host)
+        conn.timeout = CALLBACK_TIMEOUT
+        return conn
+
+
+class SafeTimeoutTransport(xmlrpclib.SafeTransport):
+
+    def make_connection(self, host):
+        conn = xmlrpclib.SafeTransport.make_connection(self, host)
+        conn.timeout = CALLBACK_TIMEOUT
+        return conn
+
+
+class Dispatcher(object):
+
+    def __init__(self, log):
+        self.log = log
+        self.proxies = {}
+        self.single = set()  # servers without multicall support
+        self.listeners = {}
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def proxy(self, address):
+        if address not in self.proxies:
+            if urlparse(address).scheme == "https":
+                transport = SafeTimeoutTransport()
+            else:
+                transport = TimeoutTransport()
+            self.proxies[address] = xmlrpclib.ServerProxy(address, transport=transport, allow_none=True)
+        return self.proxies[address]
+
+    def start(self):
+        self.listeners.clear()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def notify(self):
+        self.wake.set()
+
+    # tell whether a server accepts connections on the address of callbacks
+    def listening(self, address):
+        if address not in self.listeners:
+            parsed = urlparse(address)
+            port = parsed.port or (443 if parsed.scheme == "https" else 80)
+            try:
+                socket.create_connection((parsed.hostname, port), CALLBACK_TIMEOUT).close()
+                self.listeners[address] = True
+            except socket.error as e:
+                self.listeners[address] = getattr(e, "errno", None) != errno.ECONNREFUSED
+        return self.listeners[address]
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wake.wait(1)
+            self.wake.clear()
+            self.deliver()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        self.thread.join()
+        self.deliver()
+
+    def deliver(self):
+        down = {}  # address -> whether the server is only busy
+        while True:
+            with Jobs() as jobs:
+                events = jobs.outbox(CALLBACK_BATCH)
+            if len(events) == 0:
+                return
+            batches = collections.OrderedDict()
+            for event in events:
+                batches.setdefault(event[1], []).append(event)
+            delivered, failed, runs = [], [], []
+            for address, batch in batches.iteritems():
+                if address in down:
+                    failed.extend([(event, down[address]) for event in batch])
+                    continue
+                try:
+                    self.send(address, batch)
+                    delivered.extend([event[0] for event in batch])
+                    runs.extend([event[6] for event in batch if event[6] is not None])
+                except (socket.error, httplib.HTTPException, xmlrpclib.Error) as e:
+                    offline = getattr(e, "errno", None) == errno.ECONNREFUSED
+                    busy = getattr(e, "faultCode", None) == CALLBACK_BUSY
+                    if not offline:
+                        self.log("Cannot deliver callbacks to {}: {}".format(address, e))
+                    down[address] = busy
+                    failed.extend([(event, down[address]) for event in batch])
+            # callbacks to busy servers are retried until delivered
+            dropped = [event for event, retry in failed if not retry and event[3] + 1 >= CALLBACK_RETRIES]
+            with Jobs() as jobs:
+                jobs.delivered(delivered)
+                jobs.called_back(runs)
+                jobs.delivered([event[0] for event in dropped])
+                for event, _ in failed:
+                    if event not in dropped:
+                        jobs.postpone(event[0], min(5 * 2 ** event[3], 3600))
+            for event in dropped:
+                self.log("Dropped callback of {} to {} after {} attempts".format(event[2], event[1], event[3] + 1))
+
+    def payload(self, event):
+        return event[2], json.loads(event[5] or "[]"), event[4]
+
+    def send(self, address, events):
+        proxy = self.proxy(address)
+        if address not in self.single:
+            multi = xmlrpclib.MultiCall(proxy)
+            for event in events:
+                multi.ping(*self.payload(event))
+            try:
+                results = multi()
+            except xmlrpclib.Fault as e:
+                if e.faultCode == CALLBACK_BUSY:
+                    raise
+                self.single.add(address)
+            else:
+                for i in range(len(events)):
+                    try:
+                        results[i]
+                    except xmlrpclib.Fault as e:
+                        self.log("Unexpected RPC error: {}".format(e))
+                return
+        for event in events:
+            try:
+                proxy.ping(*self.payload(event))
+            except xmlrpclib.Fault as e:
+                if e.faultCode == CALLBACK_BUSY:
+                    raise
+                self.log("Unexpected RPC error: {}".format(e))
+
+
+class NotModified(Exception):
+    pass
+
+
+class LeaseLost(Exception):
+    pass
+
+
+# fetch pages with conditional headers and skip parsing of unchanged pages
+def conditional_reader(psr, dataplan, content_hash, changed):
+    digest = hashlib.sha1(json.dumps([dataplan.get("define"), dataplan.get("declare")], sort_keys=True))
+    def read_url(url, **kwargs):
+        try:
+            response = urllib2.urlopen(psr.decorate_headers(url), **kwargs)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                raise NotModified()
+            return False, str(e)
+        except Exception as e:
+            return False, str(e)
+        body, headers = response.read(), response.info()
+        digest.update(body)
+        changed.extend([headers.get("ETag"), headers.get("Last-Modified"), digest.hexdigest()])
+        if changed[-1] == content_hash:
+            raise NotModified()
+        return True, urllib.addinfourl(io.BytesIO(body), headers, response.geturl(), response.getcode())
+    return read_url
+
+# nearest-rank percentile of sorted values
+def percentile(values, rank):
+    if len(values) == 0:
+        return None
+    return values[max(int(math.ceil(rank * len(values))) - 1, 0)]
+
+# escape a label value of the prometheus text format
+def prometheus_label(value):
+    return unicode(value).replace(u"\\", u"\\\\").replace(u"\"", u"\\\"").replace(u"\n", u"\\n")
+
+# wrap a function to add the seconds spent in its calls to timings
+def timed(func, timings, key):
+    def wrapper(*args, **kwargs):
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[key] = timings.get(key, 0) + time.time() - started
+    return wrapper
+
+# parse a timestamp of the jobs database (UTC) as seconds since epoch
+def parse_timestamp(value):
+    try:
+        return calendar.timegm(time.strptime(value[:19], "%Y-%m-%d %H:%M:%S"))
+    except (TypeError, ValueError):
+        return None
+
+# perform dataplans sent through a pipe with hap imported only once
+def hap_worker(conn, parser, encoder):
+    from hap.log import Log
+    Log.configure(True)
+    os.setsid()  # killed together with the jobs it forks
+    while True:
+        message = conn.recv()
+        if message is None:
+            return
+        if JOB_MEMORY > 0 or JOB_CPU > 0:
+            hap_forked(conn, message, parser, encoder)
+        else:
+            conn.send(hap_job(message, parser, encoder))
+
+# perform a dataplan in a child of the worker, so that resource limits count only that job
+def hap_forked(conn, message, parser, encoder):
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            limit_resources()
+            conn.send(hap_job(message, parser, encoder))
+            code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status) or os.WEXITSTATUS(status) != 0:
+        code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        conn.send((None, None, code, exit_error(code), {}))
+
+# perform a dataplan and describe its outcome
+def hap_job(message, parser, encoder):
+    from hap.log import Log
+    job, (etag, last_modified, content_hash) = message
+    Log.info(u"Filepath: {}".format(job))
+    changed, exit_code, error, timings = [], 0, None, {}
+    try:
+        dataplan = load_plan(job)
+        conditional = dataplan.get("link", "").startswith(("http://", "https://"))
+        if conditional:
+            headers = dataplan.setdefault("config", {}).setdefault("headers", {})
+            if etag:
+                headers.setdefault("If-None-Match", etag)
+            if last_modified:
+                headers.setdefault("If-Modified-Since", last_modified)
+        psr = parser(dataplan, no_cache=True)
+        psr.data, psr.records, psr.headers = {}, {}, {}  # shared by class
+        if conditional:
+            psr.read_url = conditional_reader(psr, dataplan, content_hash, changed)
+        psr.read_url = timed(psr.read_url, timings, "fetch")
+        started = time.time()
+        output = json.dumps(psr.run().get_records(), cls=encoder)
+        timings["extract"] = time.time() - started - timings.get("fetch", 0)
+    except NotModified:
+        Log.info(u"Not modified since last run")
+        output = False
+    except SystemExit as e:  # hap exits on fatal errors
+        output, exit_code = None, e.code if isinstance(e.code, int) else 1
+        error = unicode(e.code)
+    except BaseException as e:
+        output, exit_code, error = None, 1, unicode(e) or type(e).__name__
+    return output, tuple(changed) or None, exit_code, error, timings
+
+class Engine(object):
+
+    def __init__(self, name=HAP_ENGINE):
+        self.name = name
+        self.lock = threading.Lock()
+        self.workers = []
+        self.idle = Queue.Queue()
+
+    def start(self, workers):
+        if self.name != "worker" or len(self.workers) >= workers:
+            return
+        try:
+            from hap.parser import HTMLParser
+            from hap.util import DecimalEncoder
+        except ImportError as e:
+            print("Cannot import hap ({}), running jobs as subprocesses".format(e))
+            self.name = "subprocess"
+            return
+        self.args = (HTMLParser, DecimalEncoder)
+        while len(self.workers) < workers:
+            self.spawn()
+
+    def spawn(self):
+        conn, child = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=hap_worker, args=(child,) + self.args)
+        proc.daemon = True
+        proc.start()
+        with self.lock:
+            self.workers.append((proc, conn))
+        self.idle.put((proc, conn))
+
+    def kill(self, proc, conn):
+        if proc.is_alive():
+            kill_group(proc.pid, threading.Event())
+        proc.join()
+        conn.close()
+        with self.lock:
+            self.workers.remove((proc, conn))
+
+    def run(self, job, validators, timeout=JOB_TIMEOUT):
+        queued = time.time()
+        while self.name == "worker":
+            with self.lock:
+                if len(self.workers) == 0:
+                    break
+            try:
+                worker = self.idle.get(timeout=1)
+            except Queue.Empty:
+                continue
+            return self.run_worker(job, validators, timeout, {"wait": time.time() - queued}, *worker)
+        return self.run_subprocess(job, timeout, {"wait": time.time() - queued})
+
+    def run_worker(self, job, validators, timeout, timings, proc, conn):
+        started = time.time()
+        try:
+            conn.send((job, validators))
+            timings["spawn"] = time.time() - started
+            if not conn.poll(timeout or None):
+                self.kill(proc, conn)
+                self.spawn()
+                return None, None, -signal.SIGKILL, exit_error(-signal.SIGKILL, timeout), timings
+            output = conn.recv()
+        except (EOFError, IOError):
+            self.kill(proc, conn)
+            self.spawn()
+            return None, None, proc.exitcode, exit_error(proc.exitcode), timings
+        self.idle.put((proc, conn))
+        output[-1].update(timings)
+        return output
+
+    def run_subprocess(self, job, timeout, timings):
+        started = time.time()
+        cmd = [HAP_BIN_PATH, job, "--verbose", "--no-cache"]
+        killed = threading.Event()
+        plan = json.dumps(load_plan(job))
+        proc = subprocess.Popen(session_command(cmd), stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        timings["spawn"] = time.time() - started
+        timer = threading.Timer(timeout, kill_group, [proc.pid, killed])
+        timer.daemon = True
+        timeout and timer.start()
+        try:
+            output, _ = proc.communicate(plan)
+        finally:
+            timer.cancel()
+            timeout and timer.join()
+        if proc.returncode != 0:
+            return None, None, proc.returncode, exit_error(proc.returncode, timeout if killed.is_set() else None), timings
+        return output, None, 0, None, timings
+
 
 class Task(object):
 
     def __init__(self):
-        self.tasks = {}
+        self.tasks, self.failed = {}, []
+        self.engine = Engine()
+        self.dispatcher = Dispatcher(self.log)
+        self.output = threading.Lock()
+        self.owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), int(time.time()))
+
+    def log(self, message):
+        with self.output:
+            print(message)
+            sys.stdout.flush()
+
+    def run_forever(self):
+        self.log("Manager daemon {} started".format(self.owner))
+        timers, version = [], None
+        while True:
+            due = len(timers) > 0 and timers[0][0] <= time.time()
+            if due:
+                self.run_fifo()
+            with Jobs() as jobs:
+                changed = jobs.data_version()
+                if due or changed != version:
+                    timers = jobs.upcoming(DAEMON_TIMERS)
+                    heapq.heapify(timers)
+                    version = changed
+            self.dispatcher.deliver()
+            delay = DAEMON_POLL
+            if len(timers) > 0:
+                delay = min(delay, max(timers[0][0] - time.time(), 0))
+            time.sleep(delay)
 
     def run_fifo(self):
+        self.tasks, self.failed = collections.OrderedDict(), []
+        with ProcessLock(), Jobs() as jobs:
+            depth, age = jobs.backlog()
+            claimed, slots = self.throttle(jobs, jobs.claim_due(self.owner, LEASE_TIME, BATCH_SIZE))
+            for j in claimed:
+                self.tasks.setdefault(parse_job(j, "dataplan"), []).append(j)
+        if depth > 0:
+            self.log("Queue has {} due job(s), oldest waiting for {}s".format(depth, age))
+        self.dispatcher.start()
+        pool = Pool(slots=slots)
+        total = sum([len(group) for group in self.tasks.itervalues()])
+        self.engine.start(min(pool.workers, total))
+        for group in self.tasks.itervalues():
+            for j in group:
+                pool.submit(parse_job(j, "link"), self.run_job, j)
+        elapsed = pool.join()
+        self.dispatcher.stop()
+        if total > 0:
+            self.log("Finished {} job(s) of {} dataplan(s) in {:.2f}s ({:.2f} jobs/s, {} failed)".format(
+                total, len(self.tasks), elapsed, total / max(elapsed, 0.001), len(self.failed)))
+        if total > 0 or STATS_TEXTFILE:
+            with Jobs() as jobs:
+                jobs.prune_stats(STATS_DAYS)
+                if STATS_TEXTFILE:
+                    Stats(jobs, hours=1).textfile(STATS_TEXTFILE)
+
+    # take the tokens of rate limited hosts for the claimed jobs from buckets shared by all runs,
+    # deferring the jobs which could not start before their lease expires until a token is free
+    def throttle(self, jobs, claimed):
+        if HOST_RATE <= 0:
+            return claimed, {}
+        buckets, slots, kept = {}, {}, []
+        for j in claimed:
+            link = parse_job(j, "link")
+            host = urlparse(link).netloc
+            if host not in buckets:
+                buckets[host] = jobs.bucket(host)
+            delay = buckets[host].delay()
+            if delay > LEASE_TIME:
+                jobs.release(link, self.owner, int(math.ceil(delay)))
+                continue
+            buckets[host].take()
+            slots.setdefault(host, collections.deque()).append(time.time() + delay)
+            kept.append(j)
+        for host, bucket in buckets.iteritems():
+            jobs.save_bucket(host, bucket)
+        return kept, slots
+
+    def run_job(self, j):
+        link, job = parse_job(j, "link"), parse_job(j, "job_file")
+        validators = tuple([parse_job(j, k) for k in ("etag", "last_modified", "content_hash")])
+        output, done, exit_code, error = None, None, None, "Unexpected error"
+        started, saved, timings, lost = time.time(), None, {}, False
+        timeout = job_timeout(j)
         with Jobs() as jobs:
-            for j in jobs.select_fifo24():
-                dataplan_name = parse_job(j, "dataplan")
-                if dataplan_name in self.tasks:
-                    continue
-                dataplan_job = parse_job(j, "job_file")
-                callback_job = parse_job(j, "callback")
-                self.tasks.update({dataplan_name: (dataplan_job, callback_job)})
-                link = parse_job(j, "link")
-                jobs.ping(link)
-        for dp, cb in self.tasks.itervalues():
-            self.resolve_job(dp) and self.callback_job(dp, cb)
-
-    def resolve_job(self, job):
-        job_file = open(job)
-        cmd = [HAP_BIN_PATH, job, "--save", "--verbose", "--no-cache"]
-        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        _, verbose = proc.communicate(input=job_file.read())
-        job_file.close()
-        print(verbose)
-        return verbose is not None
-
-    def callback_job(self, job, callback_address=None):
-        if callback_address is None:
-            callback_address = RPC_ADDRESS
-        rpc = xmlrpclib.ServerProxy(callback_address, allow_none=True)
-        try:
-            rpc.ping(job)
-        except xmlrpclib.ProtocolError as e:
-            print("Unsupported RPC call: {}".format(e))
-        except xmlrpclib.Fault as e:
-            print("Unexpected RPC error: {}".format(e))
-        except socket.error:
-            pass  # server is offline?
+            if not jobs.renew(link, self.owner, LEASE_TIME + timeout):
+                self.log("Skipped job leased by another run: {}".format(link))
+                return
+        try:
+            output, validators, exit_code, error, timings = self.engine.run(job, validators, timeout)
+            saved = time.time()
+            if output is False:
+                self.log("Not modified since last run: {}".format(link))
+            elif output is not None:
+                done = self.resolve_job(link, job, output, parse_job(j, "store"), parse_job(j, "record_hash"))
+                if done is None:
+                    error = "Unsupported output from hap"
+        except LeaseLost:
+            lost = True
+        finally:
+            if lost:
+                self.log("Dropped record of job leased by another run: {}".format(link))
+            else:
+                callback = parse_job(j, "callback")
+                if done is not None and callback is None and self.dispatcher.listening(RPC_ADDRESS):
+                    callback = RPC_ADDRESS  # default server is optional, skip it when nothing listens
+                with Jobs() as jobs:
+                    if output is False or done is not None:
+                        jobs.finish(link, self.owner, next_slot(link, parse_job(j, "interval")), exit_code)
+                    else:
+                        self.failed.append(link)
+                        jobs.fail(link, self.owner, exit_code, error)
+                    if done is not None:
+                        offset, record, digest = done
+                        if validators is not None:
+                            jobs.save_validators(link, *validators)
+                        jobs.save_record_hash(link, digest)
+                        outcome = "unchanged" if is_heartbeat(record) else "stored"
+                    else:
+                        outcome = "not_modified" if output is False else "failed"
+                    due = parse_timestamp(parse_job(j, "next_run_at"))
+                    timings.update(wait=max(started - due, 0) + timings.get("wait", 0) if due is not None else None,
+                                   total=time.time() - started)
+                    if saved is not None:
+                        timings.update(save=time.time() - saved)
+                    run_id = jobs.save_stats(link, parse_job(j, "dataplan"), outcome, int(done is not None), timings)
+                    if outcome == "stored" and callback is not None:
+                        jobs.enqueue(callback, job, offset, [record], run_id)
+        done and self.dispatcher.notify()
+
+    def resolve_job(self, link, job, output, store, record_hash):
+        try:
+            record = json.loads(output)
+        except (TypeError, ValueError):
+            return None
+        digest = record_digest(record)
+        if store == "changes" and digest == record_hash:
+            record = {"_datetime": record.get("_datetime"), "_unchanged": True}
+        records = Records(job)
+        with Jobs() as jobs:
+            if not jobs.renew(link, self.owner, LEASE_TIME):
+                raise LeaseLost()
+            before = records.stat()
+            records.append(record)
+            if not jobs.count_record(job, record_time(record), before, records.stat()):
+                records.summarize(jobs)
+            offset = jobs.count_records(job) - 1
+        return offset, record, digest
 
 
 def console(prefix="handle_"):
-    if not os.isatty(__stdin__):
+    if "--daemon" in sys.argv[1:] or not (os.isatty(__stdin__) or len(sys.argv) > 1):
         return False
 
     # initialize console application
@@ -400,12 +2235,16 @@ def console(prefix="handle_"):
     return True
 
 def task():
-    if os.isatty(__stdin__):
+    daemon = "--daemon" in sys.argv[1:]
+    if (os.isatty(__stdin__) or len(sys.argv) > 1) and not daemon:
         return False
 
-    # initialize app and run fifo
+    # initialize app and run fifo once or keep running as daemon
     app = Task()
-    app.run_fifo()
+    if daemon:
+        app.run_forever()
+    else:
+        app.run_fifo()
 
     return True
 
@@ -23,6 +23,7 @@
 
 from __future__ import print_function
 
+import os
 import sys
 import json
 
@@ -34,37 +35,97 @@ assert __name__ == "__main__", "Cannot use file as a module"
 if not len(sys.argv) > 1:
     raise SystemExit("Nothing to view")
 
-# read dataplan from file
-filename, dataplan = sys.argv[1], {}
-try:
+# define file name of the catalog cache inside the dataplans directory
+CATALOG_CACHE = ".catalog"
+
+# read dataplan from file and keep its declarations with a sample from the first record
+def summarize(filename):
     with open(filename, "rb") as fd:
         dataplan = json.load(fd)
-except Exception as e:
-    raise SystemExit("Cannot open dataplan: {}".format(e))
-
-# get declarations
-declarations = dataplan.get("declare", {})
-
-# find max length of key declaration
-max_key_len = max([len(k) for k in declarations.keys()])
+    declarations = dataplan.get("declare", {})
+    first_record = (dataplan.get("records") or [{}])[0]
+    return {
+        "declare": declarations,
+        "sample": dict([(k, first_record.get(k)) for k in declarations]),
+    }
 
-# get first record
-first_record = dataplan.get("records", []).pop(0)
+# summarize every dataplan of a directory, reusing cached summaries of unchanged files
+def catalog(directory):
+    cache_file = os.path.join(directory, CATALOG_CACHE)
+    try:
+        with open(cache_file, "rb") as fd:
+            cache = json.load(fd)
+    except (IOError, ValueError):
+        cache = {}
+    entries, changed = [], False
+    for name in sorted(os.listdir(directory)):
+        filename = os.path.join(directory, name)
+        if not name.endswith(".json") or not os.path.isfile(filename):
+            continue
+        stat = os.stat(filename)
+        mtime = [stat.st_mtime, stat.st_size]
+        entry = cache.get(name)
+        if entry is None or entry.get("mtime") != mtime:
+            try:
+                entry = summarize(filename)
+            except Exception as e:
+                entry = {"error": "Cannot open dataplan: {}".format(e)}
+            entry["mtime"], cache[name], changed = mtime, entry, True
+        entries.append((name, entry))
+    if len(cache) != len(entries):
+        cache, changed = dict(entries), True
+    if changed:
+        try:
+            with open(cache_file + ".tmp", "wb") as fd:
+                json.dump(cache, fd, separators=(",", ":"))
+            os.rename(cache_file + ".tmp", cache_file)
+        except (IOError, OSError):
+            pass
+    return entries
 
 # viewer formatter
-def view(field, type, sample):
-    global max_key_len
-    line_fmt = u"{:<" + unicode(max_key_len) + u"} | {:<10} | {}"
+def view(field, type, sample, max_key_len, indent=u""):
+    line_fmt = indent + u"{:<" + unicode(max_key_len) + u"} | {:<10} | {}"
     print(line_fmt.format(field, type, sample).encode("utf-8"))
 
 # viewer separator
-def separator():
-    global max_key_len
-    line_sep = ("=" * (max_key_len+1)) + "|" + ("=" * 12) + "|" + ("=" * 60)
+def separator(max_key_len, indent=u""):
+    line_sep = indent + ("=" * (max_key_len+1)) + "|" + ("=" * 12) + "|" + ("=" * 60)
     print(line_sep)
 
 # display table-like view
-view("Field", "Type", "Sample")
-separator()
-for k, v in declarations.iteritems():
-    view(k, v, first_record.get(k))
+def table(summary, indent=u""):
+    declarations, sample = summary.get("declare", {}), summary.get("sample", {})
+    max_key_len = max([len(k) for k in declarations.keys()] or [0])
+    view("Field", "Type", "Sample", max_key_len, indent)
+    separator(max_key_len, indent)
+    for k, v in declarations.iteritems():
+        view(k, v, sample.get(k), max_key_len, indent)
+
+# display all dataplans of a directory at once
+if sys.argv[1] == "--catalog":
+    if not len(sys.argv) > 2 or not os.path.isdir(sys.argv[2]):
+        raise SystemExit("Usage: --catalog DIRECTORY [--json]")
+    entries = catalog(sys.argv[2])
+    if "--json" in sys.argv[3:]:
+        summaries = [dict(summary, name=name) for name, summary in entries]
+        for summary in summaries:
+            summary.pop("mtime")
+        print(json.dumps(summaries, indent=4, sort_keys=True))
+        raise SystemExit
+    print("Found {} master dataplan(s):".format(len(entries)))
+    for name, summary in entries:
+        print("# {}".format(name))
+        if "error" in summary:
+            print("  {}".format(summary["error"]))
+        else:
+            table(summary, u"  ")
+    raise SystemExit
+
+# read dataplan from file
+try:
+    summary = summarize(sys.argv[1])
+except Exception as e:
+    raise SystemExit("Cannot open dataplan: {}".format(e))
+
+table(summary)
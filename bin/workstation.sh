@@ -67,6 +67,8 @@ After=network.target
 [Service]
 User=$(whoami)
 Environment=HAP_PORT=23513
+Environment=HAP_THREADS=8
+Environment=HAP_QUEUE_SIZE=64
 ExecStart=$WORKSTATION_PATH/$HAP_WORKSTATION
 Restart=always
 RestartSec=10
@@ -200,16 +200,6 @@ dataplans () {
         exit 1
     fi
 
-    index=1
-    echo "Found $(ls "$HAP_DIR" | wc -w) master dataplan(s):"
-    for file in $(ls "$HAP_DIR"); do
-        if [ "$HAP_DIR/$file" != "$(find "$HAP_DIR/$file" -name '*.json' 2> /dev/null)" ]; then
-            continue
-        fi
-        echo "# $file"
-        $HAP_VIEWER "$HAP_DIR/$file" | while read line; do
-            echo "  $line"
-        done
-        index=$(expr 1 + $index)
-    done
+    [ $# -gt 0 ] && shift
+    $HAP_VIEWER --catalog "$HAP_DIR" "$@"
 }
@@ -25,6 +25,7 @@ join() {
     [ $# -gt 2 ] && shift
     dataplan=$1
     link=$2
+    interval=$3
 
     if [ -z "$dataplan" ]; then
         echo "Error: missing dataplan"
@@ -92,19 +93,27 @@ join() {
     echo "Notice: for the appropriate dataplan structure and please"
     echo "Notice: evaluate the correctness of the results"
 
+    if [ "$link" = "--from" ]; then
+        if [ -z "$3" ]; then
+            echo "Error: missing file of links"
+            echo "Error: please provide a file with one link per line or - for stdin"
+            exit 1
+        fi
+        if ! $HAP_VALIDATOR "$HAP_DIR/$dataplan"; then
+            exit 1
+        fi
+        $HAP_MANAGER join "$dataplan" --from "$3" $4
+        exit $?
+    fi
+
     if $HAP_VALIDATOR "$HAP_DIR/$dataplan"; then
-        result="$($HAP_MANAGER join $dataplan $link)"
+        result="$($HAP_MANAGER join $dataplan $link $interval)"
         if [ ! $? -eq 0 ]; then
             echo "$result" | tr -d '\n'
             exit 1
         else
-            message="$(echo "$result" | cut -d ":" -f1)"
-            job_file="$(echo "$result" | cut -d ":" -f2)"
-            if ! $HAP_BIN $job_file --verbose --refresh --no-cache --save 2>> $HAP_JOBS_LOG; then
-                echo "Failed to run $job_file"
-                exit 1
-            fi
-            echo $message
+            echo "$result" | cut -d ":" -f1
+            echo "First run is queued for the next run of the manager"
         fi
     fi
 
@@ -176,6 +185,33 @@ resume() {
     $HAP_MANAGER resume $link
 }
 
+configure() {
+    [ $# -gt 3 ] && shift
+    link=$1
+    key=$2
+    value=$3
+
+    if [ -z "$link" ]; then
+        echo "Error: missing link"
+        echo "Error: please provide second argument as link"
+        exit 1
+    fi
+
+    if [ -z "$key" ] || [ -z "$value" ]; then
+        echo "Error: missing setting"
+        echo "Error: please provide a setting name and its value after link"
+        exit 1
+    fi
+
+    if [ -z "$HAP_MANAGER" ]; then
+        echo "Fatal: missing hap manager path"
+        echo "Fatal: please reinstall utils and try again"
+        exit 1
+    fi
+
+    $HAP_MANAGER configure $link $key $value
+}
+
 dump() {
     [ $# -gt 1 ] && shift
     link=$1
@@ -192,5 +228,73 @@ dump() {
         exit 1
     fi
 
-    $HAP_MANAGER dump $link
+    shift
+    $HAP_MANAGER dump $link "$@"
+}
+
+compact() {
+    [ $# -gt 0 ] && shift
+
+    if [ -z "$HAP_MANAGER" ]; then
+        echo "Fatal: missing hap manager path"
+        echo "Fatal: please reinstall utils and try again"
+        exit 1
+    fi
+
+    $HAP_MANAGER compact "$@"
+}
+
+stats() {
+    [ $# -gt 0 ] && shift
+
+    if [ -z "$HAP_MANAGER" ]; then
+        echo "Fatal: missing hap manager path"
+        echo "Fatal: please reinstall utils and try again"
+        exit 1
+    fi
+
+    $HAP_MANAGER stats "$@"
+}
+
+migrate() {
+    if [ -z "$HAP_MANAGER" ]; then
+        echo "Fatal: missing hap manager path"
+        echo "Fatal: please reinstall utils and try again"
+        exit 1
+    fi
+    $HAP_MANAGER migrate
+}
+
+rebase() {
+    [ $# -gt 1 ] && shift
+    dataplan=$1
+
+    if [ -z "$dataplan" ]; then
+        echo "Error: missing dataplan"
+        echo "Error: please provide second argument as dataplan"
+        exit 1
+    fi
+
+    if [ -z "$HAP_MANAGER" ]; then
+        echo "Fatal: missing hap manager path"
+        echo "Fatal: please reinstall utils and try again"
+        exit 1
+    fi
+
+    if [ -z "$HAP_VALIDATOR" ]; then
+        echo "Fatal: missing hap validator path"
+        echo "Fatal: please reinstall utils and try again"
+        exit 1
+    fi
+
+    if [ "$HAP_DIR/$dataplan" != "$(find $HAP_DIR/$dataplan -name '*.json' 2> /dev/null)" ]; then
+        dataplan="${dataplan}.json"
+    fi
+
+    if ! $HAP_VALIDATOR "$HAP_DIR/$dataplan"; then
+        echo "Error: validation failed for dataplan $dataplan"
+        exit 1
+    fi
+
+    $HAP_MANAGER rebase $dataplan
 }
@@ -21,19 +21,112 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import os
+import sys
+import gzip
 import json
+import time
+import Queue
+import itertools
+import threading
+import xmlrpclib
 
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+
+# Server parameters
+PORT = int(os.environ.get("HAP_PORT", 23513))
+THREADS = int(os.environ.get("HAP_THREADS", 8))
+QUEUE_SIZE = int(os.environ.get("HAP_QUEUE_SIZE", 64))
+
+# Fault code asking the manager to deliver callbacks later
+BUSY = 429
+
+
+# Drop clients which are too slow to send their requests
+class RequestHandler(SimpleXMLRPCRequestHandler):
+    timeout = 10
+
+
+# Reply to every call with a busy fault
+class BusyRequestHandler(RequestHandler):
+
+    def _dispatch(self, method, params):
+        raise xmlrpclib.Fault(BUSY, "Server is busy")
+
+
+# Handle requests with a fixed pool of threads and a bounded queue
+class Workstation(SimpleXMLRPCServer):
+
+    def __init__(self, address, threads=THREADS, queue_size=QUEUE_SIZE):
+        SimpleXMLRPCServer.__init__(self, address, requestHandler=RequestHandler,
+                                    allow_none=True, logRequests=False)
+        self.requests = Queue.Queue(queue_size)
+        for _ in range(threads):
+            thread = threading.Thread(target=self.serve_requests)
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address))
+        except Queue.Full:
+            try:
+                BusyRequestHandler(request, client_address, self)
+            finally:
+                self.shutdown_request(request)
+
+    def serve_requests(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def _dispatch(self, method, params):
+        started = time.time()
+        try:
+            return SimpleXMLRPCServer._dispatch(self, method, params)
+        finally:
+            print("{} took {:.1f}ms ({} request(s) queued)".format(
+                method, (time.time() - started) * 1000, self.requests.qsize()))
+            sys.stdout.flush()
 
 
 # Create server
-server = SimpleXMLRPCServer(("localhost", 23513))
+server = Workstation(("localhost", PORT))
 
-# Check if all fields are non-null
-def non_null(job_dataplan):
+# Read records saved to job dataplan, to its compressed segments and to
+# its append-only records file
+def records(job_dataplan):
     with open(job_dataplan) as fd:
-        ctx = json.load(fd)
-    for record in ctx.get("records", []):
+        for record in json.load(fd).get("records", []):
+            yield record
+    base, sequence = os.path.splitext(job_dataplan)[0], 1
+    segments = ["{}.0.jsonl.gz".format(base)]
+    while os.path.exists("{}.{}.jsonl.gz".format(base, sequence)):
+        segments.append("{}.{}.jsonl.gz".format(base, sequence))
+        sequence += 1
+    for records_file in segments + [base + ".jsonl"]:
+        if not os.path.exists(records_file):
+            continue
+        with (gzip.open if records_file.endswith(".gz") else open)(records_file) as fd:
+            for line in fd:
+                if line.strip():
+                    yield json.loads(line)
+
+# Read records collected since offset (e.g. missed by a server restart)
+def records_since(job_dataplan, offset):
+    return itertools.islice(records(job_dataplan), offset, None)
+
+# Check if all fields of the new records are non-null
+def non_null(job_dataplan, new_records=None, offset=None):
+    if new_records is None:
+        new_records = records(job_dataplan)
+    for record in new_records:
         for field, value in record.iteritems():
             if value is None:
                 print("Job might be outdated ({} is null)".format(field))
@@ -41,5 +134,8 @@ def non_null(job_dataplan):
 # Register function as "ping" callback
 server.register_function(non_null, "ping")
 
+# Accept callbacks delivered in batches by the manager
+server.register_multicall_functions()
+
 # Run the server's main loop
 server.serve_forever()
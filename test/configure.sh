@@ -0,0 +1,39 @@
+#!/bin/bash
+#
+# Copyright 2018 Alexandru Catrina
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+source libs/common.sh
+source libs/job.sh
+
+export HAP_BIN=/usr/local/bin/hap
+export HAP_DIR=/tmp/.hap
+export HAP_JOBS_DIR=/tmp/.hap/.jobs
+export HAP_JOBS_DB=/tmp/jobs.db
+export HAP_MANAGER=bin/manager.py
+
+mkdir -p $HAP_DIR
+
+if [ ! $# -eq 3 ]; then
+    echo "Usage: configure LINK KEY VALUE"
+    exit 1
+fi
+
+configure _ $@
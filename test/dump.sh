@@ -31,8 +31,8 @@ export HAP_MANAGER=bin/manager.py
 
 mkdir -p $HAP_DIR
 
-if [ ! $# -eq 1 ]; then
-    echo "Usage: dump LINK"
+if [ $# -lt 1 ]; then
+    echo "Usage: dump LINK [flags]"
     exit 1
 fi
 
@@ -0,0 +1,55 @@
+#!/bin/bash
+#
+# Copyright 2018 Alexandru Catrina
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+export HAP_BIN=/usr/local/bin/hap
+export HAP_DIR=/tmp/.hap-heartbeat
+export HAP_JOBS_DIR=/tmp/.hap-heartbeat/.jobs
+export HAP_JOBS_DB=/tmp/.hap-heartbeat/jobs.db
+export HAP_MANAGER=bin/manager.py
+
+LINK=http://localhost/heartbeat
+
+rm -rf $HAP_DIR
+mkdir -p $HAP_JOBS_DIR
+cp res/sample.json $HAP_DIR/sample.json
+$HAP_MANAGER join sample.json $LINK > /dev/null || exit 1
+
+# two records of the same day long ago, then a heartbeat repeating the second one
+JOB_FILE=$(ls $HAP_JOBS_DIR/*.json | head -n 1)
+python -c "
+import time
+noon = (int(time.time()) // 86400 - 3) * 86400 + 43200
+print('{\"_datetime\": %d, \"github\": \"A\"}' % noon)
+print('{\"_datetime\": %d, \"github\": \"B\"}' % (noon + 60))
+print('{\"_datetime\": %d, \"_unchanged\": true}' % time.time())
+" > ${JOB_FILE%.json}.jsonl
+
+# downsampling keeps A and archives B, so the heartbeat must be stored with B's values
+$HAP_MANAGER compact --days 1 --downsample day || exit 1
+LAST=$($HAP_MANAGER dump $LINK --expand --output - | tail -n 1)
+if [[ "$LAST" != *B* ]]; then
+    echo "Expected heartbeat to repeat B after compact, got: $LAST"
+    exit 1
+fi
+
+echo "Heartbeat kept the values of the archived record"
+rm -rf $HAP_DIR
@@ -33,8 +33,8 @@ export HAP_VALIDATOR=bin/validator.py
 
 mkdir -p $HAP_DIR
 
-if [ ! $# -eq 2 ]; then
-    echo "Usage: join DATAPLAN LINK"
+if [ $# -lt 2 ] || [ $# -gt 4 ]; then
+    echo "Usage: join DATAPLAN LINK|--from FILE|- [HOURS]"
     exit 1
 fi
 